@@ -1,6 +1,6 @@
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr
+from esportsbench.utils import is_null_or_empty
 
 
 class CallOfDutyDataPipeline(LPDBDataPipeline):
@@ -25,10 +25,9 @@ class CallOfDutyDataPipeline(LPDBDataPipeline):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
 
     def process_data(self):
-        df = pl.scan_ndjson(self.raw_data_dir / 'call_of_duty.jsonl', infer_schema_length=100000).collect()
-        print(f'initial row count: {df.shape[0]}')
+        df = self.scan_raw('call_of_duty.jsonl')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date', drop_cols=['match2opponents'])
+        df = self.filter_invalid_dates(df, 'invalid_date', drop_cols=['match2opponents'])
 
         # filter out matches without exactly 2 teams
         not_two_teams_expr = pl.col('match2opponents').list.len() != 2
@@ -1,7 +1,9 @@
 import argparse
+import pathlib
 from datasets import load_dataset
+from esportsbench.data_pipeline.diff import diff_datasets, print_diff_summary, write_diff
 
-def main(va, vb):
+def main(va, vb, diff=False, output_dir=None):
     dataset_a = load_dataset(
         "EsportsBench/EsportsBench",
         revision=va
@@ -16,9 +18,15 @@ def main(va, vb):
         if (split == 'fifa') and ('fifa' not in dataset_b):
             split = 'ea_sports_fc'
         df_b = dataset_b[split].to_polars()
-        diff = len(df_b) - len(df_a)
-        total += diff
-        print(f'{split}: {diff} new rows')
+        if diff:
+            # row counts can hide rows which were removed and replaced
+            split_diff = diff_datasets(df_a, df_b)
+            print_diff_summary(split, split_diff)
+            if output_dir is not None:
+                write_diff(split_diff, pathlib.Path(output_dir), split)
+        num_new_rows = len(df_b) - len(df_a)
+        total += num_new_rows
+        print(f'{split}: {num_new_rows} new rows')
     print(f'total new rows: {total}')
 
 
@@ -27,5 +35,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-va', default='4.0')
     parser.add_argument('-vb', default='5.0')
+    parser.add_argument('-d', '--diff', action='store_true', help='report added, removed and changed rows per game')
+    parser.add_argument('-o', '--output_dir', required=False, help='write the diffed rows as csv here')
     args = parser.parse_args()
-    main(args.va, args.vb)
\ No newline at end of file
+    main(args.va, args.vb, args.diff, args.output_dir)
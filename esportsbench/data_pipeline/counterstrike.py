@@ -1,6 +1,6 @@
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr
+from esportsbench.utils import is_null_or_empty
 
 
 class CounterStrikeDataPipeline(LPDBDataPipeline):
@@ -26,14 +26,13 @@ class CounterStrikeDataPipeline(LPDBDataPipeline):
     def process_data(self):
         """read data from raw jsonl, filter invalid data, process and write to final data  location"""
 
-        df = pl.scan_ndjson(
-            self.raw_data_dir / 'counterstrike.jsonl',
-            infer_schema_length=100000,
+        df = self.scan_raw(
+            'counterstrike.jsonl',
             low_memory=True,
             ignore_errors=True,
         )
         print('filtering invalid dates')
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
        
         # # filter out matches without exactly 2 teams
         # not_two_teams_expr = pl.col('match2opponents').list.len() != 2
@@ -55,7 +54,7 @@ class CounterStrikeDataPipeline(LPDBDataPipeline):
             pl.col('team_2_struct').struct.field('teamtemplate').struct.field('name').alias('team_2_template_name'),
             pl.col('team_2_struct').struct.field('teamtemplate').struct.field('page').alias('team_2_template_page'),
             pl.col('team_2_struct').struct.field('score').cast(pl.Float64).alias('team_2_score'),
-        ).drop('team_1_struct', 'team_2_struct').collect()
+        ).drop('team_1_struct', 'team_2_struct')
 
         # use name if it is not null, use template otherwise
         df = df.with_columns(
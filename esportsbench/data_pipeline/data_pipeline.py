@@ -4,16 +4,30 @@ Each data pipeline must implement ingest_data and process_data methods
 """
 
 from abc import ABC
-from typing import List, Dict
+from datetime import datetime, timedelta
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 import json
+import fcntl
+import sqlite3
+import multiprocessing
 from pathlib import Path
+from urllib.parse import urlparse
 import os
 import polars as pl
 from requests import Request, Response
 from requests_cache import CachedSession
 from dotenv import load_dotenv
-from esportsbench.utils import is_null_or_empty, outcome_from_scores
+from esportsbench.utils import is_null_or_empty, parsed_date_expr, invalid_date
+from esportsbench.data_pipeline.raw_store import JsonlRawStore, ArrowRawStore
+from esportsbench.data_pipeline.raw_schema import read_schema, write_schema, schema_drift
+from esportsbench.data_pipeline.snapshot import StreamingSnapshotStats, snapshot_metadata
+
+# dates are datetimes in the parquet files, the csv files keep the same readable format as the raw data
+CSV_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
 def print_request(request):
@@ -33,25 +47,73 @@ class Waiter:
         self.timeout = timeout
         self.prev_time = time.time()
         self.first_time = True  # we do not need to wait on the first call of a run
-
-    def wait(self):
-        if self.first_time:
-            self.first_time = False
-        else:
-            time_since_prev = time.time() - self.prev_time
-            wait_time = max(0, self.timeout - time_since_prev)
-            if wait_time > 0:
-                print(f'waiting {wait_time} seconds before issuing the request')
-                time.sleep(wait_time)
-            self.prev_time = time.time()
+        self.lock = threading.Lock()  # prefetching threads share one waiter so requests stay spaced out
+
+    def __getstate__(self):
+        # locks can't be pickled, pipelines are sent to worker processes
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def wait(self, request=None):
+        with self.lock:
+            if self.first_time:
+                self.first_time = False
+            else:
+                time_since_prev = time.time() - self.prev_time
+                wait_time = max(0, self.timeout - time_since_prev)
+                if wait_time > 0:
+                    print(f'waiting {wait_time} seconds before issuing the request')
+                    time.sleep(wait_time)
+                self.prev_time = time.time()
+
+
+class SharedWaiter:
+    """token bucket rate limiter shared by all processes on this machine
+    the bucket for each host is stored in a small state file which is guarded by a lock file
+    """
+
+    def __init__(self, timeout, state_dir, burst=1):
+        self.timeout = timeout  # seconds to refill one token
+        self.burst = burst  # max number of requests which can be made back to back
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+
+    def wait(self, request=None):
+        if self.timeout <= 0:
+            return
+        host = urlparse(request.url).hostname if request is not None else 'default'
+        state_path = self.state_dir / f'{host}.json'
+        with open(self.state_dir / f'{host}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            now = time.time()
+            tokens, prev_time = self.burst, now
+            if state_path.exists():
+                state = json.loads(state_path.read_text())
+                tokens, prev_time = state['tokens'], state['time']
+            tokens = min(self.burst, tokens + (now - prev_time) / self.timeout)
+            wait_time = max(0.0, (1.0 - tokens) * self.timeout)
+            # take the token now (possibly going into debt) so other processes queue up behind this request
+            state_path.write_text(json.dumps({'tokens': tokens - 1.0, 'time': now}))
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        if wait_time > 0:
+            print(f'waiting {wait_time} seconds before issuing the request to {host}')
+            time.sleep(wait_time)
 
 
 class DataPipeline(ABC):
     """base class for ingesting and processing data from various APIs"""
 
     game: str = None
-    schema_overrides: Dict = None
-    request_params_groups: Dict = None
+    schema_overrides: dict = None
+    request_params_groups: dict = None
+    # filename -> {column: dtype}, declared columns take precedence over the learned schema
+    raw_schemas: dict = None
+    raw_date_col: str = 'date'  # raw column the final date is parsed from, pages are requested in order of it
 
     def __init__(
         self,
@@ -59,31 +121,51 @@ class DataPipeline(ABC):
         timeout,
         keys_to_refresh=None,
         max_rows=float('inf'),
+        num_workers=1,
+        shared_rate_limit=False,
+        resume=False,
+        raw_format='jsonl',
+        incremental_process=False,
         **kwargs,
     ):
         self.rows_per_request = rows_per_request
-        self.waiter = Waiter(timeout=timeout)
+        self.num_workers = num_workers  # number of pages to have in flight at once during ingestion
         self.keys_to_refresh = []
         if keys_to_refresh is not None:
             self.keys_to_refresh = keys_to_refresh
         self.max_rows = max_rows
+        self.resume = resume  # pick up from the last checkpointed page instead of rewriting the raw data
+        self.raw_format = raw_format  # 'jsonl' or 'arrow', see raw_store.py
+        # only process raw pages which weren't processed last time and merge them into the existing full data
+        self.incremental_process = incremental_process
+        self.keys_to_process = None  # filename -> request keys scan_raw is restricted to, None means everything
 
         data_dir = Path(__file__).resolve().parents[2] / 'data'
         self.raw_data_dir = data_dir / 'raw_data'
-        self.invalid_data_dir = data_dir / 'invalid_data' / self.game
+        self.invalid_data_dir = data_dir / 'invalid_data'
+        self.rejections = []  # (reason, row as json) frames collected by filter_invalid during processing
         self.full_data_dir = data_dir / 'full_data'
         os.makedirs(data_dir, exist_ok=True)
         os.makedirs(self.raw_data_dir, exist_ok=True)
+        os.makedirs(self.raw_data_dir / 'checkpoints', exist_ok=True)
+        os.makedirs(self.raw_data_dir / 'schemas', exist_ok=True)
         os.makedirs(self.invalid_data_dir, exist_ok=True)
         os.makedirs(self.full_data_dir / 'csv', exist_ok=True)
         os.makedirs(self.full_data_dir / 'parquet', exist_ok=True) 
+        os.makedirs(self.full_data_dir / 'state', exist_ok=True)
+
+        # with shared_rate_limit all pipelines hitting the same host share one request budget, even across processes
+        if shared_rate_limit:
+            self.waiter = SharedWaiter(timeout=timeout, state_dir=data_dir / 'rate_limits')
+        else:
+            self.waiter = Waiter(timeout=timeout)
 
         cache_dir = data_dir / 'requests_cache'
         os.makedirs(cache_dir, exist_ok=True)
         self.cache_path = cache_dir / self.game
 
 
-    def process_response(self, response: Response) -> List[dict]:
+    def process_response(self, response: Response) -> list[dict]:
         raise NotImplementedError
 
     def ingest_data(self):
@@ -91,119 +173,541 @@ class DataPipeline(ABC):
             request_iterator = self.get_request_iterator(request_params)
             self.ingest_data_for_group(filename, request_iterator)
 
-    def ingest_data_for_group(self, filename, request_iterator):
-        """main ingestion method. Makes requests from the iterate_requests methods, processes the
-        results and writes the raw data to disk.
-        """
-        sess = CachedSession(
+    def get_session(self):
+        return CachedSession(
             self.cache_path,
             backend='sqlite',
             allowable_methods=('GET', 'POST'),
             ignored_parameters=['Authorization', 'X-API-KEY', 'access_token', 'api_key', 'apikey'],
         )
-        output_path = self.raw_data_dir / filename
-        with open(output_path, 'w', encoding='utf8') as out_file:
-            num_rows = 0
+
+    def fetch_page(self, sess, request):
+        """send a single request (from the cache if possible) and process the response
+        returns the request key, the processed rows and whether this was the last page
+        """
+        request_key = sess.cache.create_key(request)
+        cache_has_key = sess.cache.contains(request_key)
+        force_refresh = (not cache_has_key) or (request_key in self.keys_to_refresh)
+        if force_refresh:
+            self.waiter.wait(request)
+        response = sess.send(request, force_refresh=force_refresh)
+        processed_rows, is_done = self.process_response(response)
+
+        if (cache_has_key and is_done):
+            print(f'response had less than {self.rows_per_request} rows, retrying with force_refresh=True')
+            self.waiter.wait(request)
+            response = sess.send(request, force_refresh=True)
+            processed_rows, is_done = self.process_response(response)
+        return request_key, processed_rows, is_done
+
+    def prepare_rows(self, rows, request_key):
+        """tag rows with the request they came from and apply the schema overrides, modifies the rows in place"""
+        for row in rows:
+            row['request_key'] = request_key
+            if self.schema_overrides is not None:
+                for key, value in self.schema_overrides.items():
+                    if key in row:
+                        row[key] = value(row[key])
+            # HACKY HACKY HACK
+            if ('match2opponents' in row):
+                for opp in row['match2opponents']:
+                    if ('extradata' in opp) and (opp['extradata'] == []):
+                        opp['extradata'] = None
+        return rows
+
+    def get_raw_store(self, filename, suffix=''):
+        """the raw store for a request group, suffix is for temporary stores which later replace the real one"""
+        if self.raw_format == 'jsonl':
+            return JsonlRawStore(self.raw_data_dir / f'{filename}{suffix}')
+        if self.raw_format == 'arrow':
+            return ArrowRawStore(self.raw_data_dir / f'{Path(filename).stem}{suffix}')
+        raise ValueError('raw_format must be either jsonl or arrow')
+
+    def get_raw_schema(self, filename, refresh=False):
+        """schema for a request group's raw data
+        the learned schema is persisted and only relearned (in one pass) when the raw data has changed since
+        any differences from the previous schema are printed so drift in the API responses is noticed
+        """
+        store = self.get_raw_store(filename)
+        schema_path = self.raw_data_dir / 'schemas' / f'{filename}.json'
+        schema = read_schema(schema_path) if schema_path.exists() else None
+        if refresh or (schema is None) or (store.mtime() > schema_path.stat().st_mtime):
+            print(f'learning schema for {filename}')
+            learned = store.learn_schema()
+            if schema is not None:
+                for change in schema_drift(schema, learned):
+                    print(f'schema drift in {filename}: {change}')
+            schema = learned
+            write_schema(schema_path, schema)
+        declared = (self.raw_schemas or {}).get(filename, {})
+        return {**schema, **declared}
+
+    def learn_raw_schemas(self):
+        for filename in self.request_params_groups:
+            if self.get_raw_store(filename).exists():
+                self.get_raw_schema(filename, refresh=True)
+
+    def scan_raw(self, filename, **kwargs):
+        """lazily read the raw data for a request group with its explicit schema
+        kwargs are passed to scan_ndjson for jsonl stores
+        """
+        df = self.get_raw_store(filename).scan(schema=self.get_raw_schema(filename), **kwargs)
+        if self.keys_to_process is not None:
+            df = df.filter(pl.col('request_key').is_in(self.keys_to_process.get(filename, [])))
+        return df
+
+    def read_checkpoint(self, filename):
+        checkpoint_path = self.raw_data_dir / 'checkpoints' / f'{filename}.json'
+        if not checkpoint_path.exists():
+            return None
+        return json.loads(checkpoint_path.read_text())
+
+    def write_checkpoint(self, filename, checkpoint):
+        """atomically replace the checkpoint for a request group"""
+        checkpoint_path = self.raw_data_dir / 'checkpoints' / f'{filename}.json'
+        tmp_path = checkpoint_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(checkpoint))
+        os.replace(tmp_path, checkpoint_path)
+
+    def clear_checkpoint(self, filename):
+        (self.raw_data_dir / 'checkpoints' / f'{filename}.json').unlink(missing_ok=True)
+
+    def resume_from_checkpoint(self, filename, store, sess, request_iterator):
+        """skip the pages which are already committed to the raw store
+        returns the checkpoint to resume from (None if starting over) and the iterator over the remaining requests
+        """
+        checkpoint = self.read_checkpoint(filename)
+        if (checkpoint is None) or (not store.can_resume_from(checkpoint['position'])):
+            return None, request_iterator
+        skipped = [next(request_iterator) for _ in range(checkpoint['num_pages'])]
+        # the request keys only line up if the request params and rows_per_request are unchanged
+        if (len(skipped) > 0) and (sess.cache.create_key(skipped[-1]) != checkpoint['request_key']):
+            print(f'checkpoint for {filename} does not match the current requests, starting over')
+            return None, chain(skipped, request_iterator)
+        print(f'resuming {filename} from offset {checkpoint["offset"]} ({checkpoint["num_rows"]} rows already written)')
+        return checkpoint, request_iterator
+
+    def ingest_data_for_group(self, filename, request_iterator, start_position=None):
+        """main ingestion method. Makes requests from the iterate_requests methods, processes the
+        results and writes the raw data to disk.
+        Up to num_workers pages are fetched concurrently, they are still written in offset order.
+        Whenever the raw store is durable a checkpoint is written so an interrupted run can be resumed with resume=True.
+        If start_position is given, the existing raw data is kept up to that position and the new rows are appended.
+        No checkpoints are written then, the pages of the delta requests don't line up with the full requests
+        and an interrupted incremental run is picked up by running it again.
+        """
+        sess = self.get_session()
+        store = self.get_raw_store(filename)
+        checkpoint = None
+        if start_position is not None:
+            checkpoint = {'num_pages': 0, 'offset': 0, 'request_key': None, 'position': start_position, 'num_rows': 0}
+        elif self.resume:
+            checkpoint, request_iterator = self.resume_from_checkpoint(filename, store, sess, request_iterator)
+        if (checkpoint is None) or (start_position is not None):
+            # a checkpoint that isn't resumed from would point into the rows about to be rewritten
+            self.clear_checkpoint(filename)
+        if checkpoint is None:
+            checkpoint = {'num_pages': 0, 'offset': 0, 'request_key': None, 'position': 0, 'num_rows': 0}
+
+        # drops anything written after the last committed page
+        store.open(checkpoint['position'])
+        # set as soon as any fetched page is short, offsets past it would only come back empty
+        end_reached = threading.Event()
+
+        def fetch(request):
+            if end_reached.is_set():
+                # queued before the short page came back, skip sending it
+                return sess.cache.create_key(request), [], True
+            result = self.fetch_page(sess, request)
+            if result[2]:
+                end_reached.set()
+            return result
+
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            num_rows = checkpoint['num_rows']
+            num_pages = checkpoint['num_pages']
             is_done = False
-            req_idx = 0
+            pending = deque()
             while not is_done:
-                request = next(request_iterator)
-                print('current request:')
-                print_request(request)
-                request_key = sess.cache.create_key(request)
-                cache_has_key = sess.cache.contains(request_key)
-                force_refresh = (not cache_has_key) or (request_key in self.keys_to_refresh)
-                if force_refresh:
-                    self.waiter.wait()
-                response = sess.send(request, force_refresh=force_refresh)
-                processed_rows, is_done = self.process_response(response)
-
-                if (cache_has_key and is_done):
-                    print(f'response had less than {self.rows_per_request} rows, retrying with force_refresh=True')
-                    self.waiter.wait()
-                    response = sess.send(request, force_refresh=True)
-                    processed_rows, is_done = self.process_response(response)
-
+                # don't prefetch more pages than max_rows can still use
+                while (
+                    (len(pending) < self.num_workers)
+                    and (not end_reached.is_set())
+                    and (num_rows + len(pending) * self.rows_per_request < self.max_rows)
+                ):
+                    request = next(request_iterator, None)
+                    if request is None:
+                        break
+                    print('current request:')
+                    print_request(request)
+                    pending.append(executor.submit(fetch, request))
+                if len(pending) == 0:
+                    break
+
+                request_key, processed_rows, is_done = pending.popleft().result()
                 num_rows += len(processed_rows)
-                req_idx += 1
-
-                for row in processed_rows:
-                    row['request_key'] = request_key
-                    if self.schema_overrides is not None:
-                        for key, value in self.schema_overrides.items():
-                            if key in row:
-                                row[key] = value(row[key])
-                    # HACKY HACKY HACK
-                    if ('match2opponents' in row):
-                        for opp in row['match2opponents']:
-                            if ('extradata' in opp) and (opp['extradata'] == []):
-                                opp['extradata'] = None
-                    out_file.write(json.dumps(row) + '\n')
-                out_file.flush()
+                num_pages += 1
+                store.write_page(store.encode_page(self.prepare_rows(processed_rows, request_key)))
+                # the last page is never committed since it can still grow, resuming will fetch it again
+                position = store.commit()
+                if (not is_done) and (position is not None) and (start_position is None):
+                    checkpoint = {
+                        'num_pages': num_pages,
+                        'offset': num_pages * self.rows_per_request,
+                        'request_key': request_key,
+                        'position': position,  # byte offset for jsonl, number of shards for arrow
+                        'num_rows': num_rows,
+                    }
+                    self.write_checkpoint(filename, checkpoint)
                 if num_rows >= self.max_rows:
                     is_done = True
                 if num_rows == 0:
                     is_done = True
                     sess.cache.delete(request_key)
+
+            # pages prefetched past the end of the data are never written, don't leave them in the cache
+            # pages with rows are kept, they are valid and a later run with a larger max_rows can use them
+            for future in pending:
+                if future.cancel() or (future.exception() is not None):
+                    continue
+                request_key, processed_rows, _ = future.result()
+                if len(processed_rows) == 0:
+                    sess.cache.delete(request_key)
+        store.close()
+        sess.close()
+        print(f'wrote {num_rows} to {store.path}')
+
+    def rebuild_raw_from_cache(self, num_processes=1):
+        """rewrite the raw data for every request group using only the responses in the requests cache
+        nothing is sent over the network, useful after changing schema_overrides or process_response
+        """
+        for filename, request_params in self.request_params_groups.items():
+            request_iterator = self.get_request_iterator(request_params)
+            self.rebuild_raw_for_group(filename, request_iterator, num_processes)
+
+    def rebuild_raw_for_group(self, filename, request_iterator, num_processes=1):
+        sess = self.get_session()
+        db_path = sess.cache.responses.db_path
+        table_name = sess.cache.responses.table_name
+        cached_keys = set(sess.cache.responses.keys())
+
+        # the request keys can be computed without sending anything, walk the pages in offset order until one is missing
+        request_keys = []
+        for request in request_iterator:
+            request_key = sess.cache.create_key(request)
+            if request_key not in cached_keys:
+                break
+            request_keys.append(request_key)
         sess.close()
-        print(f'wrote {num_rows} to {output_path}')
+        print(f'found {len(request_keys)} cached pages for {filename}')
+
+        def iterate_values():
+            con = sqlite3.connect(db_path)
+            batch_size = 500
+            for start in range(0, len(request_keys), batch_size):
+                batch_keys = request_keys[start : start + batch_size]
+                placeholders = ','.join('?' * len(batch_keys))
+                query = f'SELECT key, value FROM {table_name} WHERE key IN ({placeholders})'
+                values = dict(con.execute(query, batch_keys).fetchall())
+                for request_key in batch_keys:
+                    yield request_key, values[request_key]
+            con.close()
+
+        tmp_store = self.get_raw_store(filename, suffix='.rebuild')
+        if num_processes > 1:
+            # polars is not fork safe, the workers have to be spawned
+            pool = multiprocessing.get_context('spawn').Pool(
+                num_processes, initializer=init_cache_decoder, initargs=(self, tmp_store)
+            )
+            decoded_pages = pool.imap(decode_cached_page, iterate_values(), chunksize=8)
+        else:
+            init_cache_decoder(self, tmp_store)
+            decoded_pages = map(decode_cached_page, iterate_values())
+
+        checkpoint = {'num_pages': 0, 'offset': 0, 'request_key': None, 'position': 0, 'num_rows': 0}
+        num_rows = 0
+        is_done = False
+        tmp_store.open()
+        for num_pages, (request_key, page_num_rows, page, is_done) in enumerate(decoded_pages, start=1):
+            tmp_store.write_page(page)
+            num_rows += page_num_rows
+            position = tmp_store.commit()
+            if is_done:
+                break
+            if position is not None:
+                checkpoint = {
+                    'num_pages': num_pages,
+                    'offset': num_pages * self.rows_per_request,
+                    'request_key': request_key,
+                    'position': position,
+                    'num_rows': num_rows,
+                }
+        tmp_store.close()
+        if num_processes > 1:
+            pool.terminate()
+            pool.join()
+
+        if not is_done:
+            # the last page of a complete ingestion is always partial, without it the cache only has part of the data
+            print(f'cache does not reach the end of {filename}, leaving the existing raw data in place')
+            tmp_store.remove()
+            return
+        store = self.get_raw_store(filename)
+        store.replace(tmp_store)
+        self.write_checkpoint(filename, checkpoint)
+        print(f'rebuilt {num_rows} rows to {store.path} from the cache')
 
     def migrate_cache(self):
         """Re-key all existing cache entries to exclude API key params from the cache key.
         Call this once after switching to a new API key.
         """
-        sess = CachedSession(
-            self.cache_path,
-            backend='sqlite',
-            allowable_methods=('GET', 'POST'),
-            ignored_parameters=['Authorization', 'X-API-KEY', 'access_token', 'api_key', 'apikey'],
-        )
+        sess = self.get_session()
         sess.cache.recreate_keys()
         sess.close()
         print(f'Cache migration complete for {self.cache_path}')
 
     def process_and_write(self):
-        df = self.process_data()
-        print(f'{self.game} final row count: {df.shape[0]}')
-        df.write_csv(self.full_data_dir / 'csv' / f'{self.game}.csv')
-        df.write_parquet(self.full_data_dir / 'parquet' / f'{self.game}.parquet')
+        """build the processing plan and collect it once, the final data and the rejections are sunk in the same pass"""
+        self.rejections = []
+        self.keys_to_process = None
+        if self.incremental_process:
+            return self.process_and_merge()
+        outputs = self.get_outputs(self.process_data().lazy())
+        sinks = []
+        for name, df in outputs.items():
+            csv_path = self.full_data_dir / 'csv' / f'{name}.csv'
+            sinks.append(df.sink_csv(csv_path, datetime_format=CSV_DATETIME_FORMAT, lazy=True))
+            # the snapshot stats are counted as the rows stream into the parquet sink and written into its footer
+            stats = StreamingSnapshotStats()
+            parquet_path = self.full_data_dir / 'parquet' / f'{name}.parquet'
+            sinks.append(stats.track(df).sink_parquet(parquet_path, metadata=stats.metadata, lazy=True))
+        rejections_path = self.invalid_data_dir / f'{self.game}.parquet'
+        sinks.append(self.get_rejections().sink_parquet(rejections_path, compression='zstd', lazy=True))
+        pl.collect_all(sinks, engine='streaming')
+        self.rejections = []
+        self.print_process_summary(outputs)
+
+    def print_process_summary(self, outputs):
+        for name in outputs:
+            parquet_path = self.full_data_dir / 'parquet' / f'{name}.parquet'
+            num_rows = pl.scan_parquet(parquet_path).select(pl.len()).collect().item()
+            print(f'{name} final row count: {num_rows}')
+        rejections_path = self.invalid_data_dir / f'{self.game}.parquet'
+        rejected_counts = (
+            pl.scan_parquet(rejections_path).group_by('reason').len().sort('len', descending=True).collect()
+        )
+        for reason, count in rejected_counts.iter_rows():
+            print(f'{self.game} rejected {count} rows for {reason}')
+
+    def get_raw_page_stats(self, filename):
+        """request key -> (number of raw rows, first valid date, last valid date) for the rows from that request"""
+        date = invalid_date(parsed_date_expr)
+        date = pl.when(~date).then(parsed_date_expr)
+        stats = (
+            self.scan_raw(filename)
+            .select('request_key', pl.col(self.raw_date_col).cast(pl.Utf8).alias('date'))
+            .group_by('request_key')
+            .agg(pl.len(), date.min().alias('min_date'), date.max().alias('max_date'))
+            .collect(engine='streaming')
+        )
+        to_str = lambda value: None if value is None else value.isoformat(sep=' ')
+        return {
+            key: (count, to_str(min_date), to_str(max_date)) for key, count, min_date, max_date in stats.iter_rows()
+        }
 
-    def process_data(self) -> pl.DataFrame:
+    def process_and_merge(self):
+        """process only the raw pages whose rows changed since the last run and merge the results into the full data
+        a page counts as processed once its request key was processed with the same number of rows
+        pages are requested in date order, so everything from the first date of a changed or vanished page onwards is
+        the reprocessed window: every page with rows in it is reprocessed and every existing row in it is replaced,
+        which drops matches that are now rejected or no longer in the raw data, same as processing everything
+        """
+        state_path = self.full_data_dir / 'state' / f'{self.game}.json'
+        state = json.loads(state_path.read_text()) if state_path.exists() else None
+        page_stats = {
+            filename: self.get_raw_page_stats(filename)
+            for filename in self.request_params_groups
+            if self.get_raw_store(filename).exists()
+        }
+        key_counts = {
+            filename: {key: stats[0] for key, stats in pages.items()} for filename, pages in page_stats.items()
+        }
+        key_dates = {
+            filename: {key: stats[1:] for key, stats in pages.items()} for filename, pages in page_stats.items()
+        }
+        # state from before the page dates were stored can't locate the window
+        can_merge = (state is not None) and ('dates' in state) and all(
+            (self.full_data_dir / 'parquet' / f'{name}.parquet').exists() for name in state['outputs']
+        )
+        window_start = None
+        if can_merge:
+            old_counts, old_dates = state['raw'], state['dates']
+            changed = {
+                filename: [key for key, count in counts.items() if old_counts.get(filename, {}).get(key) != count]
+                for filename, counts in key_counts.items()
+            }
+            vanished = {
+                filename: [key for key in counts if key not in key_counts.get(filename, {})]
+                for filename, counts in old_counts.items()
+            }
+            num_changed = sum(map(len, changed.values()))
+            num_vanished = sum(map(len, vanished.values()))
+            if num_changed + num_vanished == 0:
+                print(f'{self.game} has no new raw data to process')
+                return
+            # old and new first dates of the changed pages and the first dates of the pages which are gone
+            old_first_date = lambda filename, key: old_dates.get(filename, {}).get(key, [None])[0]
+            first_dates = [key_dates[filename][key][0] for filename, keys in changed.items() for key in keys]
+            first_dates += [old_first_date(filename, key) for filename, keys in changed.items() for key in keys]
+            first_dates += [old_first_date(filename, key) for filename, keys in vanished.items() for key in keys]
+            first_dates = [first_date for first_date in first_dates if first_date is not None]
+            if len(first_dates) > 0:
+                window_start = min(first_dates)
+                self.keys_to_process = {
+                    filename: [
+                        key
+                        for key, (min_date, max_date) in dates.items()
+                        if (key in changed[filename]) or ((max_date is not None) and (max_date >= window_start))
+                    ]
+                    for filename, dates in key_dates.items()
+                }
+                num_keys = sum(map(len, self.keys_to_process.values()))
+                print(
+                    f'{self.game} {num_changed} raw pages changed and {num_vanished} are gone, '
+                    f'processing {num_keys} pages with matches from {window_start} on'
+                )
+            else:
+                # only pages without any valid dates changed, nothing in the full data came from them
+                self.keys_to_process = changed
+                print(f'{self.game} processing {num_changed} changed raw pages without valid dates')
+        else:
+            print(f'{self.game} has no usable previous processing state, processing everything')
+
+        outputs = self.get_outputs(self.process_data().lazy())
+        *new_dfs, new_rejected = pl.collect_all(list(outputs.values()) + [self.get_rejections()], engine='streaming')
+        self.rejections = []
+
+        rejections_path = self.invalid_data_dir / f'{self.game}.parquet'
+        if can_merge and rejections_path.exists():
+            # keep the old rejections from pages which are still in the raw data and weren't just reprocessed
+            kept_keys = {
+                key
+                for filename, counts in key_counts.items()
+                for key in set(counts) - set(self.keys_to_process.get(filename, []))
+            }
+            request_key = pl.col('row').str.json_path_match('$.request_key')
+            old_rejected = pl.read_parquet(rejections_path).filter(request_key.is_null() | request_key.is_in(kept_keys))
+            new_rejected = pl.concat([old_rejected, new_rejected])
+        new_rejected.write_parquet(rejections_path, compression='zstd')
+        self.keys_to_process = None
+
+        for name, new_df in zip(outputs, new_dfs):
+            parquet_path = self.full_data_dir / 'parquet' / f'{name}.parquet'
+            df = new_df
+            if can_merge:
+                old_df = pl.read_parquet(parquet_path)
+                if old_df.schema['date'] == pl.Utf8:
+                    # full data written before dates were parsed at process time
+                    old_df = old_df.with_columns(parsed_date_expr.alias('date'))
+                if window_start is not None:
+                    # every page with matches in the window was just reprocessed, so whatever isn't in new_df is gone
+                    old_df = old_df.filter(pl.col('date') < datetime.fromisoformat(window_start))
+                df = (
+                    pl.concat(
+                        [old_df.join(new_df, on='match_id', how='anti'), new_df],
+                        how='vertical_relaxed',
+                    )
+                    .unique()
+                    .sort('date', 'match_id')
+                )
+            df.write_csv(self.full_data_dir / 'csv' / f'{name}.csv', datetime_format=CSV_DATETIME_FORMAT)
+            # the merged data is already in memory so the snapshot stats are cheap to store in the footer here
+            df.write_parquet(parquet_path, metadata=snapshot_metadata(df))
+
+        state = {'outputs': list(outputs), 'raw': key_counts, 'dates': key_dates}
+        tmp_path = state_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, state_path)
+        self.print_process_summary(outputs)
+
+    def estimate_process_memory(self):
+        """rough number of bytes process_and_write needs, based on the size of the raw data"""
+        stores = [self.get_raw_store(filename) for filename in self.request_params_groups]
+        return sum(store.size() * store.memory_factor for store in stores)
+
+    def get_outputs(self, df: pl.LazyFrame) -> dict[str, pl.LazyFrame]:
+        """name -> final data to write, pipelines whose raw data covers several games split it up here"""
+        return {self.game: df}
+
+    def process_data(self) -> pl.LazyFrame:
         raise NotImplementedError
 
-    def filter_invalid(self, df: pl.DataFrame, invalid_expr: pl.Expr, invalid_file_name: str, drop_cols: list = None):
+    def filter_invalid(
+        self, df: pl.DataFrame, invalid_expr: pl.Expr, invalid_file_name: str, drop_cols: list | None = None
+    ):
         """given a dataframe and an expression:
-        filter rows from a dataframe, write the filtered rows to disk, return the filtered df
+        filter rows from a dataframe, record the filtered rows under the reason invalid_file_name,
+        return the filtered df
+        the expression is evaluated once, rows where it is null are dropped without being recorded
 
         Usage:
         invalid_expr = pl.col('some_col') == 'some_invalid_value'
         df = self.filter_invalid(df, invalid_expr, 'some_col_has_invalid_value')
         """
-        invalid_rows = df.filter(invalid_expr)
+        df = df.with_columns(invalid_expr.alias('__invalid'))
+        if isinstance(df, pl.LazyFrame):
+            # the rejected rows and the survivors branch off here, caching lets both read one evaluation of the plan
+            df = df.cache()
+        invalid_rows = df.filter(pl.col('__invalid')).drop('__invalid')
         if drop_cols is not None:
             invalid_rows = invalid_rows.drop(drop_cols)
-        if isinstance(invalid_rows, pl.LazyFrame):
-            invalid_rows = invalid_rows.collect(streaming=True)
-        else:
-            invalid_rows = invalid_rows.rechunk()  # pretty sure I only need this because of a polars bug...
-        invalid_rows.write_ndjson(self.invalid_data_dir / f'{invalid_file_name}.jsonl')
-        invalid_rows = invalid_rows.clear()  # probably does nothing
-        del invalid_rows
-        df = df.filter(~invalid_expr)
-        return df
+        # rows from different steps have different columns so they are stored as json next to the reason
+        self.rejections.append(
+            invalid_rows.select(
+                pl.lit(invalid_file_name).alias('reason'),
+                pl.struct(pl.all()).struct.json_encode().alias('row'),
+            )
+        )
+        return df.filter(~pl.col('__invalid')).drop('__invalid')
 
+    def filter_invalid_dates(
+        self, df: pl.DataFrame, invalid_file_name: str = 'invalid_date', drop_cols: list | None = None
+    ):
+        """parse the string date column into a datetime, this is the only place dates get parsed
+        rows with missing, unparseable or placeholder dates are filtered and recorded with their original string date
+        """
+        df = df.with_columns(parsed_date_expr.alias('__date'))
+        drop_cols = ['__date'] + (drop_cols or [])
+        df = self.filter_invalid(df, invalid_date('__date'), invalid_file_name, drop_cols=drop_cols)
+        return df.with_columns(pl.col('__date').alias('date')).drop('__date')
 
-def unpack_players(players):
-    out_players = []
-    if isinstance(players, list):
-        for player in players:
-            if isinstance(player, dict):
-                out_players.append(player['player'])
-    if isinstance(players, dict):
-        for player in players.values():
-            if isinstance(player, dict):
-                out_players.append(player['player'])
-    return out_players
+    def get_rejections(self) -> pl.LazyFrame:
+        """every row filtered out during processing with the first reason it was rejected for"""
+        if len(self.rejections) == 0:
+            return pl.LazyFrame(schema={'reason': pl.Utf8, 'row': pl.Utf8})
+        return pl.concat([rejected.lazy() for rejected in self.rejections])
+
+
+# the cache serializer can't be pickled, each worker process builds its own from the pipeline's session
+_decoder_state = {}
+
+
+def init_cache_decoder(data_pipeline, store):
+    sess = data_pipeline.get_session()
+    _decoder_state['data_pipeline'] = data_pipeline
+    _decoder_state['store'] = store
+    _decoder_state['serializer'] = sess.cache.responses.serializer
+    sess.close()
+
+
+def decode_cached_page(item):
+    """turn a raw value from the cache db into an encoded page for the raw store"""
+    request_key, value = item
+    data_pipeline = _decoder_state['data_pipeline']
+    response = _decoder_state['serializer'].loads(value)
+    processed_rows, is_done = data_pipeline.process_response(response)
+    page = _decoder_state['store'].encode_page(data_pipeline.prepare_rows(processed_rows, request_key))
+    return request_key, len(processed_rows), page, is_done
 
 
 class LPDBDataPipeline(DataPipeline):
@@ -213,8 +717,11 @@ class LPDBDataPipeline(DataPipeline):
     # these names appear when a match did not occur, has not occured yet, or data was never entered
     invalid_competitor_names = {'bye', 'tba', 'tbd'}
 
-    def __init__(self, rows_per_request=1000, timeout=60.0, **kwargs):
+    def __init__(self, rows_per_request=1000, timeout=60.0, incremental=False, overlap_days=7, **kwargs):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
+        # in incremental mode only matches newer than the latest raw date (minus an overlap for late edits) are fetched
+        self.incremental = incremental
+        self.overlap_days = overlap_days
         load_dotenv()
         lpdb_api_key = os.getenv('LPDB_API_KEY')
         if lpdb_api_key is None:
@@ -263,6 +770,39 @@ class LPDBDataPipeline(DataPipeline):
 
         return iter(request_iterator())
 
+    def get_watermark(self, filename):
+        """returns the date cutoff to fetch newer matches from and the position in the raw store to replace from
+        returns (None, None) if the group has to be fully ingested
+        """
+        store = self.get_raw_store(filename)
+        if not store.exists():
+            return None, None
+        try:
+            max_date = datetime.strptime(store.max_date()[:19], '%Y-%m-%d %H:%M:%S')
+        except (ValueError, KeyError, TypeError):
+            return None, None
+        # don't let a bogus far future date hide everything after it
+        max_date = min(max_date, datetime.now())
+        cutoff = (max_date - timedelta(days=self.overlap_days)).strftime('%Y-%m-%d %H:%M:%S')
+        return cutoff, store.position_after_date(cutoff)
+
+    def ingest_data(self):
+        if not self.incremental:
+            return super().ingest_data()
+        for filename, request_params in self.request_params_groups.items():
+            cutoff, position = None, None
+            if request_params['order'].startswith('date ASC'):
+                cutoff, position = self.get_watermark(filename)
+            if cutoff is None:
+                print(f'no usable watermark for {filename}, ingesting everything')
+                self.ingest_data_for_group(filename, self.get_request_iterator(request_params))
+                continue
+            print(f'ingesting {filename} matches after {cutoff}, replacing raw rows from position {position}')
+            delta_params = dict(request_params)
+            delta_params['conditions'] = f'({request_params["conditions"]}) AND [[date::>{cutoff}]]'
+            request_iterator = self.get_request_iterator(delta_params)
+            self.ingest_data_for_group(filename, request_iterator, start_position=position)
+
     def process_response(self, response):
         response_text = response.text
         if (response.status_code == 200) and (response_text == ''):
@@ -277,72 +817,49 @@ class LPDBDataPipeline(DataPipeline):
             is_done = len(results) < self.rows_per_request
         return results, is_done
 
-    
     @staticmethod
-    def unpack_team_match(raw_games):
-        if raw_games == '[]':
-            return None
-        games = json.loads(raw_games)
-        outputs = []
-        for idx, game in enumerate(games):
-            if game['mode'] == '2v2':
-                continue
-            if len(game['opponents']) != 2:
-                continue
-            opponents = game['opponents']
-
-            opp_1_players = []
-            if 'players' in opponents[0]:
-                opp_1_players = unpack_players(opponents[0]['players'])
-            opp_2_players = []
-            if 'players' in opponents[1]:
-                opp_2_players = unpack_players(opponents[1]['players'])
-
-            if (len(opp_1_players) != 1) or (len(opp_2_players) != 1):
-                continue
-
-            player_1 = opp_1_players[0]
-            player_2 = opp_2_players[0]
-            try:
-                player_1_score = float(opponents[0]['score'])
-                player_2_score = float(opponents[1]['score'])
-            except:
-                continue
-            outcome = outcome_from_scores(player_1_score, player_2_score)
-            outputs.append(
-                {
-                    'player_1': player_1,
-                    'player_2': player_2,
-                    'player_1_score': float(player_1_score),
-                    'player_2_score': float(player_2_score),
-                    'outcome': outcome,
-                    'game_idx': idx,
-                    'bestof': 1,
-                }
-            )
-        return outputs
-
-    def unpack_team_matches(self, team_df):
+    def normalize_match2games(games):
+        """keep only the parts of match2games needed to unpack team matches and give them one consistent shape
+        players come back as either a list or a dict keyed by position and scores as either numbers or strings
+        """
+        out_games = []
+        for game in games:
+            opponents = []
+            for opp in game.get('opponents', []):
+                if not isinstance(opp, dict):
+                    opp = {}
+                players = opp.get('players', [])
+                if isinstance(players, dict):
+                    players = list(players.values())
+                if not isinstance(players, list):
+                    players = []
+                score = opp.get('score')
+                opponents.append({
+                    'players': [{'player': player.get('player')} for player in players if isinstance(player, dict)],
+                    'score': None if score is None else str(score),
+                })
+            out_games.append({'mode': game.get('mode'), 'opponents': opponents})
+        return out_games
+
+    def filter_empty_team_games(self, team_df):
+        """matches without any games are rejected as bad_team_game before match2games is exploded
+        explode drops empty lists without a trace so they have to be recorded first
+        """
+        no_games_expr = pl.col('match2games').is_null() | (pl.col('match2games').list.len() == 0)
+        return self.filter_invalid(team_df, no_games_expr, 'bad_team_game')
 
-        team_match_struct = pl.Struct([
-            pl.Field("player_1", pl.Utf8),
-            pl.Field("player_2", pl.Utf8),
-            pl.Field("player_1_score", pl.Float64),
-            pl.Field("player_2_score", pl.Float64),
-            pl.Field("outcome", pl.Float64),
-            pl.Field("game_idx", pl.Int64),
-            pl.Field("bestof", pl.Int64)
-        ])
-
-        team_df = team_df.with_columns(
-            pl.col('match2games').map_elements(
-                function=self.unpack_team_match,
-                skip_nulls=True,
-                return_dtype=pl.List(team_match_struct)
-            ).alias('games')
+    def filter_team_games(self, games_df, keep_expr, game_exprs):
+        """keep only the games which could be unpacked
+        matches where no game could be unpacked keep a single row of nulls so they show up in the bad_team_game data
+        """
+        games_df = games_df.with_columns(keep_expr.fill_null(False).alias('keep'))
+        has_games_expr = pl.col('keep').any().over('match_idx')
+        games_df = games_df.filter(pl.col('keep') | (~has_games_expr & (pl.col('game_idx') == 0)))
+        games_df = games_df.with_columns(
+            pl.when(pl.col('keep')).then(expr).otherwise(None).alias(expr.meta.output_name()) for expr in game_exprs
         )
+        games_df = games_df.drop('match_idx', 'keep')
 
-        games_df = team_df.explode('games').unnest('games')
         bad_team_game_expr = (
             is_null_or_empty(pl.col('player_1'))
             | is_null_or_empty(pl.col('player_2'))
@@ -358,9 +875,49 @@ class LPDBDataPipeline(DataPipeline):
             pl.col('player_2_score').cast(pl.Float64).alias('player_2_score'),
             pl.concat_str([pl.col('match2id'), pl.col('game_idx').cast(pl.Utf8)], separator='_').alias('match2id'),
         )
-
         return games_df
-    
+
+    def unpack_team_matches(self, team_df):
+        """one row per 1v1 game played within team matches, match2games must be stored by normalize_match2games"""
+        if team_df.collect_schema()['match2games'] == pl.Utf8:
+            raise ValueError('match2games is stored as a json string, regenerate the raw data with --action rebuild')
+
+        team_df = self.filter_empty_team_games(team_df)
+        games_df = (
+            team_df.with_row_index('match_idx')
+            .explode('match2games')
+            .with_columns(pl.int_range(pl.len()).over('match_idx').alias('game_idx'))
+        )
+        opponents = pl.col('match2games').struct.field('opponents')
+        opp_1 = opponents.list.get(0, null_on_oob=True)
+        opp_2 = opponents.list.get(1, null_on_oob=True)
+        player_1_score = opp_1.struct.field('score').cast(pl.Float64, strict=False)
+        player_2_score = opp_2.struct.field('score').cast(pl.Float64, strict=False)
+
+        keep_expr = (
+            (pl.col('match2games').struct.field('mode') != '2v2').fill_null(True)
+            & (opponents.list.len() == 2)
+            & (opp_1.struct.field('players').list.len() == 1)
+            & (opp_2.struct.field('players').list.len() == 1)
+            & player_1_score.is_not_null()
+            & player_2_score.is_not_null()
+        )
+        game_exprs = [
+            opp_1.struct.field('players').list.get(0, null_on_oob=True).struct.field('player').alias('player_1'),
+            opp_2.struct.field('players').list.get(0, null_on_oob=True).struct.field('player').alias('player_2'),
+            player_1_score.alias('player_1_score'),
+            player_2_score.alias('player_2_score'),
+            pl.when(player_1_score > player_2_score)
+            .then(1.0)
+            .when(player_1_score < player_2_score)
+            .then(0.0)
+            .otherwise(0.5)
+            .alias('outcome'),
+            pl.col('game_idx'),
+            pl.lit(1, dtype=pl.Int64).alias('bestof'),
+        ]
+        return self.filter_team_games(games_df, keep_expr, game_exprs)
+
     @staticmethod
     def drop_opponent_extradata(opps):
         for opp in opps:
@@ -1,113 +1,247 @@
+"""
+Validate a raw ndjson file against a schema and report every line which doesn't fit it
+A line offset index is built in one pass, then the lines are checked in chunks which can run in parallel
+The schema is the persisted raw schema for the file if there is one, otherwise it is inferred from the first lines
+"""
+
+import argparse
+import json
+import multiprocessing
 import os
+import pathlib
 import tempfile
+from collections import Counter, defaultdict
+
+import numpy as np
 import polars as pl
 
-def find_first_bad_row(file_path):
-    def create_temp_file(rows):
-        with open(file_path, 'r') as src, tempfile.NamedTemporaryFile('w', delete=False) as dst:
-            for _ in range(rows):
-                line = src.readline()
-                if not line:
-                    break
-                dst.write(line)
-            return dst.name
-
-    def create_single_row_temp(row_number):
-        with open(file_path, 'r') as src:
-            # Skip to target row
-            for _ in range(row_number - 1):
-                src.readline()
-            line = src.readline()
-            if not line:
-                return None
-            
-            with tempfile.NamedTemporaryFile('w', delete=False) as dst:
-                dst.write(line)
-                return dst.name
-
-    def test_rows(k):
-        tmp_path = None
-        try:
-            tmp_path = create_temp_file(k)
-            pl.read_ndjson(tmp_path)
-            return True
-        except (pl.exceptions.SchemaError, pl.exceptions.ComputeError):
-            return False
-        finally:
-            if tmp_path and os.path.exists(tmp_path):
-                os.unlink(tmp_path)
-
-    # Get total rows
-    with open(file_path, 'r') as f:
-        total_lines = sum(1 for _ in f)
-    print(f"Total lines: {total_lines}")
-
-    low, high = 1, total_lines
-    first_bad = None
-
-    while low <= high:
-        mid = (low + high) // 2
-        print(f"Testing first {mid} rows...", end=' ')
-        
-        if test_rows(mid):
-            print("✓ Valid schema")
-            low = mid + 1
-        else:
-            print("✗ Schema error")
-            first_bad = mid
-            high = mid - 1
-
-    # Verification and schema printing
-    if first_bad:
-        print(f"\nVerifying error at row {first_bad}:")
-        if first_bad == 1 or not test_rows(first_bad - 1):
-            print("Validation failed - check initial rows")
-            return None
-
-        # Print schema of valid rows
-        if first_bad > 1:
-            print("\nSchema of valid rows (up to row {}):".format(first_bad - 1))
-            valid_temp = create_temp_file(first_bad - 1)
-            try:
-                df_valid = pl.read_ndjson(valid_temp)
-                print(df_valid.schema)
-            except Exception as e:
-                print("Error reading valid rows:", e)
-            finally:
-                os.unlink(valid_temp)
-        else:
-            print("\nNo valid rows before first row")
+from esportsbench.data_pipeline.raw_schema import dtype_from_json, dtype_to_json, read_schema
+
+RAW_DATA_DIR = pathlib.Path(__file__).parents[2] / 'data' / 'raw_data'
+
+
+def line_offsets(file_path, block_size=1 << 26):
+    """byte offset of the start of every line, plus the file size at the end"""
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(file_path, 'rb') as f:
+        while block := f.read(block_size):
+            offsets.append(np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')) + position + 1)
+            position += len(block)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != position:
+        # last line has no trailing newline
+        offsets = np.append(offsets, position)
+    return offsets
+
+
+def json_type(value):
+    if isinstance(value, bool):
+        return 'bool'
+    return {dict: 'object', list: 'array', str: 'string', int: 'int', float: 'float', type(None): 'null'}[type(value)]
+
+
+def check_value(value, dtype, field):
+    """list of (field, expected dtype, json type) for every part of value which doesn't fit dtype"""
+    if value is None:
+        return []
+    if isinstance(dtype, pl.Struct):
+        if not isinstance(value, dict):
+            return [(field, str(dtype), json_type(value))]
+        fields = {f.name: f.dtype for f in dtype.fields}
+        conflicts = [
+            (f'{field}.{name}', 'no such field', json_type(value[name])) for name in value if name not in fields
+        ]
+        for name, inner in fields.items():
+            conflicts.extend(check_value(value.get(name), inner, f'{field}.{name}'))
+        return conflicts
+    if isinstance(dtype, pl.List):
+        if not isinstance(value, list):
+            return [(field, str(dtype), json_type(value))]
+        conflicts = []
+        for element in value:
+            conflicts.extend(check_value(element, dtype.inner, f'{field}[]'))
+        return conflicts
+    if dtype == pl.Boolean:
+        fits = isinstance(value, bool)
+    elif dtype.is_integer():
+        fits = isinstance(value, int) and not isinstance(value, bool)
+    elif dtype.is_float():
+        fits = isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif dtype == pl.Null:
+        fits = False
+    else:
+        # strings and anything parsed from strings
+        fits = isinstance(value, str)
+    return [] if fits else [(field, str(dtype), json_type(value))]
+
 
-        # Print schema of problematic row
-        print("\nSchema of problematic row (row {}):".format(first_bad))
-        problematic_temp = create_single_row_temp(first_bad)
-        if problematic_temp:
+def check_lines(file_path, start, end, first_line, schema_json):
+    """check the lines in the byte range [start, end), returns (line number, byte offset, conflicts) for the bad ones"""
+    schema = {name: dtype_from_json(obj) for name, obj in schema_json.items()}
+    bad_lines = []
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    offset = start
+    for line_idx, line in enumerate(data.split(b'\n')):
+        conflicts = []
+        if line.strip():
             try:
-                # Try reading normally first
-                df_problematic = pl.read_ndjson(problematic_temp)
-                print("Explicit schema:", df_problematic.schema)
-            except Exception as e:
-                print("Error during explicit read:", e)
-                # Fall back to lazy schema inference
-                try:
-                    lf = pl.scan_ndjson(problematic_temp)
-                    print("Inferred schema:", lf.schema)
-                except Exception as e:
-                    print("Failed to infer schema:", e)
-            finally:
-                os.unlink(problematic_temp)
-        else:
-            print("Could not read problematic row")
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                conflicts = [('<line>', 'valid json', str(e))]
+            else:
+                if not isinstance(row, dict):
+                    # valid json but not a row, eg an array
+                    conflicts = [('<line>', 'object', json_type(row))]
+                else:
+                    conflicts = [(name, 'no such field', json_type(row[name])) for name in row if name not in schema]
+                    for name, dtype in schema.items():
+                        conflicts.extend(check_value(row.get(name), dtype, name))
+        if conflicts:
+            bad_lines.append((first_line + line_idx, offset, conflicts))
+        offset += len(line) + 1
+    return bad_lines
+
 
-        return first_bad
+def value_dtype(value):
+    if value is None:
+        return pl.Null
+    if isinstance(value, dict):
+        return pl.Struct({name: value_dtype(inner) for name, inner in value.items()})
+    if isinstance(value, list):
+        inner = pl.Null
+        for element in value:
+            inner = merge_dtypes(inner, value_dtype(element)) or inner
+        return pl.List(inner)
+    return {'bool': pl.Boolean, 'int': pl.Int64, 'float': pl.Float64, 'string': pl.String}[json_type(value)]
 
+
+def merge_dtypes(a, b):
+    """smallest dtype which fits values of both, None if they conflict"""
+    if a == pl.Null:
+        return b
+    if (b == pl.Null) or (a == b):
+        return a
+    if {a, b} == {pl.Int64, pl.Float64}:
+        return pl.Float64
+    if isinstance(a, pl.Struct) and isinstance(b, pl.Struct):
+        fields = {f.name: f.dtype for f in a.fields}
+        for f in b.fields:
+            merged = merge_dtypes(fields.get(f.name, pl.Null), f.dtype)
+            fields[f.name] = fields[f.name] if (merged is None) else merged
+        return pl.Struct(fields)
+    if isinstance(a, pl.List) and isinstance(b, pl.List):
+        inner = merge_dtypes(a.inner, b.inner)
+        return None if inner is None else pl.List(inner)
     return None
 
-# Usage
-file_path = "../../data/raw_data/dota2.jsonl"
-bad_row = find_first_bad_row(file_path)
-if bad_row:
-    print(f"\nFirst schema inconsistency at row: {bad_row}")
-    print(f"Examine line {bad_row} in: {file_path}")
-else:
-    print("\nNo schema errors found in entire file")
\ No newline at end of file
+
+def infer_schema(file_path, offsets, num_lines):
+    """infer the schema from the first lines one line at a time so malformed or mixed type lines can't stop it
+    when a field has conflicting types the most common one wins and the other lines are reported as bad
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read(int(offsets[min(num_lines, len(offsets) - 1)]))
+    field_dtypes = defaultdict(Counter)
+    for line in data.split(b'\n'):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(row, dict):
+            for name, value in row.items():
+                field_dtypes[name][value_dtype(value)] += 1
+    schema = {}
+    for name, counts in field_dtypes.items():
+        dtype = pl.Null
+        for other, _ in counts.most_common():
+            dtype = merge_dtypes(dtype, other) or dtype
+        schema[name] = dtype
+    return schema
+
+
+def validate_ndjson(file_path, schema=None, num_processes=1, chunk_lines=100_000, infer_lines=1000):
+    """check every line of an ndjson file against a schema, returns a list of (line number, byte offset, conflicts)
+    line numbers start at 1, each conflict is (field, expected dtype, json type)
+    """
+    file_path = pathlib.Path(file_path)
+    offsets = line_offsets(file_path)
+    num_lines = len(offsets) - 1
+    if schema is None:
+        schema_path = RAW_DATA_DIR / 'schemas' / f'{file_path.name}.json'
+        if schema_path.exists():
+            schema = read_schema(schema_path)
+        else:
+            print(f'no schema for {file_path.name}, inferring it from the first {infer_lines} lines')
+            schema = infer_schema(file_path, offsets, infer_lines)
+    schema_json = {name: dtype_to_json(dtype) for name, dtype in schema.items()}
+    chunks = [
+        (file_path, int(offsets[idx]), int(offsets[min(idx + chunk_lines, num_lines)]), idx + 1, schema_json)
+        for idx in range(0, num_lines, chunk_lines)
+    ]
+    if (num_processes <= 1) or (len(chunks) <= 1):
+        results = [check_lines(*chunk) for chunk in chunks]
+    else:
+        # polars isn't fork safe
+        with multiprocessing.get_context('spawn').Pool(num_processes) as pool:
+            results = pool.starmap(check_lines, chunks)
+    print(f'checked {num_lines} lines of {file_path}')
+    return [bad_line for result in results for bad_line in result]
+
+
+def print_bad_lines(bad_lines, max_lines=50):
+    for line_number, offset, conflicts in bad_lines[:max_lines]:
+        print(f'line {line_number} (byte {offset}):')
+        for field, expected, actual in conflicts:
+            print(f'    {field}: expected {expected}, got {actual}')
+    if len(bad_lines) > max_lines:
+        print(f'... and {len(bad_lines) - max_lines} more')
+    print(f'{len(bad_lines)} lines don\'t fit the schema')
+
+
+def self_check():
+    """a file with a type conflict, a malformed line and a line which isn't an object checked without a schema,
+    all three lines have to be reported
+    """
+    lines = [
+        '{"id": 1, "score": 2, "team": {"name": "a"}}',
+        '{"id": 2, "score": 2.5, "team": {"name": "b", "region": null}}',
+        '{"id": "3", "score": 1, "team": {"name": "c"}}',
+        '{"id": 4, "score": 0',
+        '{"id": 5, "score": null, "team": null}',
+        '[1, 2]',
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = pathlib.Path(tmp_dir) / 'self_check.jsonl'
+        file_path.write_text('\n'.join(lines) + '\n')
+        bad_lines = validate_ndjson(file_path, chunk_lines=2)
+    print_bad_lines(bad_lines)
+    assert [line_number for line_number, _, _ in bad_lines] == [3, 4, 6], bad_lines
+    assert bad_lines[0][2] == [('id', 'Int64', 'string')], bad_lines[0]
+    assert bad_lines[2][2] == [('<line>', 'object', 'array')], bad_lines[2]
+    print('self check passed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file_path', nargs='?', help='raw ndjson file to check')
+    parser.add_argument(
+        '-s', '--schema', required=False, help='schema json to check against, defaults to the persisted raw schema'
+    )
+    parser.add_argument('-np', '--num_processes', type=int, default=os.cpu_count())
+    parser.add_argument('-cl', '--chunk_lines', type=int, default=100_000, help='lines per chunk of work')
+    parser.add_argument('-m', '--max_lines', type=int, default=50, help='max number of bad lines to print')
+    parser.add_argument(
+        '--self_check', action='store_true', help='check a small file with a type conflict and no schema'
+    )
+    args = parser.parse_args()
+    if args.self_check:
+        self_check()
+    else:
+        schema = read_schema(pathlib.Path(args.schema)) if args.schema else None
+        bad_lines = validate_ndjson(args.file_path, schema, args.num_processes, args.chunk_lines)
+        print_bad_lines(bad_lines, args.max_lines)
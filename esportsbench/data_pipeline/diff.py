@@ -0,0 +1,136 @@
+"""
+Diff two versions of match data, eg a local full_data file against a released dataset
+Rows are paired by match_id where both sides have it, then by (competitor_1, competitor_2, outcome) on the same date,
+then by the same key on the nearest date within a tolerance since dates sometimes move by a day between versions
+Everything is hash joins and one sorted asof join so million row games diff in seconds
+"""
+
+import argparse
+import os
+import pathlib
+
+import polars as pl
+
+KEY_COLS = ['competitor_1', 'competitor_2', 'outcome']
+
+
+def normalize_dates(df):
+    """dates are compared as days, older data has them as strings and full data as datetimes"""
+    if df.collect_schema()['date'] == pl.Utf8:
+        return df.with_columns(pl.col('date').str.slice(0, 10).str.to_date('%Y-%m-%d'))
+    return df.with_columns(pl.col('date').cast(pl.Date))
+
+
+def unpaired(df, pairs, idx_col):
+    return df.join(pairs.select(idx_col), on=idx_col, how='anti')
+
+
+def diff_datasets(old, new, date_tolerance='1d'):
+    """returns a dict of the rows which were added to new, removed from old and changed between them
+    changed rows have the new values and the old values in {col}_old columns
+    """
+    old = normalize_dates(old.lazy()).collect()
+    new = normalize_dates(new.lazy()).collect()
+    common = [col for col in old.columns if col in new.columns]
+    old = old.select(common).with_row_index('__old_idx')
+    new = new.select(common).with_row_index('__new_idx')
+
+    pairs = []
+    if 'match_id' in common:
+        pairs.append(
+            old.select('match_id', '__old_idx')
+            .join(new.select('match_id', '__new_idx'), on='match_id', how='inner')
+            .select('__old_idx', '__new_idx')
+            .unique('__old_idx', keep='first', maintain_order=True)
+            .unique('__new_idx', keep='first', maintain_order=True)
+        )
+
+    # the same matchup can be played several times in a day so repeats are paired in order
+    old_rest = unpaired(old, pl.concat(pairs), '__old_idx') if pairs else old
+    new_rest = unpaired(new, pl.concat(pairs), '__new_idx') if pairs else new
+    occurrence = pl.int_range(pl.len()).over(KEY_COLS + ['date']).alias('__occurrence')
+    pairs.append(
+        old_rest.with_columns(occurrence)
+        .join(new_rest.with_columns(occurrence), on=KEY_COLS + ['date', '__occurrence'], how='inner')
+        .select('__old_idx', '__new_idx')
+    )
+
+    # what's left can only pair with a row on a nearby date, each old row is used at most once
+    old_rest = unpaired(old_rest, pairs[-1], '__old_idx')
+    new_rest = unpaired(new_rest, pairs[-1], '__new_idx')
+    nearest = (
+        new_rest.select(KEY_COLS + ['date', '__new_idx'])
+        .sort('date')
+        .join_asof(
+            old_rest.select(KEY_COLS + [pl.col('date').alias('__old_date'), '__old_idx']).sort('__old_date'),
+            left_on='date',
+            right_on='__old_date',
+            by=KEY_COLS,
+            strategy='nearest',
+            tolerance=date_tolerance,
+            check_sortedness=False,  # both sides were just sorted by date
+        )
+        .filter(pl.col('__old_idx').is_not_null())
+        .sort((pl.col('date') - pl.col('__old_date')).abs(), '__new_idx')
+        .unique('__old_idx', keep='first', maintain_order=True)
+        .select('__old_idx', '__new_idx')
+    )
+    pairs = pl.concat(pairs + [nearest])
+
+    pairs = pairs.sort('__new_idx')
+    # row indexes are positions so the paired rows can be gathered instead of joined
+    changed = (
+        pl.concat(
+            [
+                new.drop('__new_idx')[pairs['__new_idx']],
+                old.drop('__old_idx')[pairs['__old_idx']].rename({col: f'{col}_old' for col in common}),
+            ],
+            how='horizontal',
+        )
+        .filter(pl.any_horizontal([pl.col(col).ne_missing(pl.col(f'{col}_old')) for col in common]))
+    )
+    return {
+        'added': unpaired(new, pairs, '__new_idx').drop('__new_idx'),
+        'removed': unpaired(old, pairs, '__old_idx').drop('__old_idx'),
+        'changed': changed,
+    }
+
+
+def print_diff_summary(name, diff):
+    counts = {kind: len(df) for kind, df in diff.items()}
+    print(f'{name}: {counts["added"]} added, {counts["removed"]} removed, {counts["changed"]} changed')
+    return counts
+
+
+def write_diff(diff, output_dir, name):
+    for kind, df in diff.items():
+        os.makedirs(output_dir / kind, exist_ok=True)
+        df.write_csv(output_dir / kind / f'{name}.csv')
+
+
+def main(old_path, new_path, output_dir=None, date_tolerance='1d'):
+    """diff two parquet files, or every game which is in both of two directories of parquet files"""
+    old_path, new_path = pathlib.Path(old_path), pathlib.Path(new_path)
+    if old_path.is_dir():
+        old_names = {path.stem for path in old_path.glob('*.parquet')}
+        names = sorted(old_names & {path.stem for path in new_path.glob('*.parquet')})
+        file_pairs = [(name, old_path / f'{name}.parquet', new_path / f'{name}.parquet') for name in names]
+    else:
+        file_pairs = [(new_path.stem, old_path, new_path)]
+    for name, old_file, new_file in file_pairs:
+        diff = diff_datasets(pl.scan_parquet(old_file), pl.scan_parquet(new_file), date_tolerance=date_tolerance)
+        print_diff_summary(name, diff)
+        if output_dir is not None:
+            write_diff(diff, pathlib.Path(output_dir), name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('old', help='old parquet file or directory of parquet files')
+    parser.add_argument('new', help='new parquet file or directory of parquet files')
+    parser.add_argument(
+        '-o', '--output_dir', required=False, help='write the added, removed and changed rows as csv here'
+    )
+    parser.add_argument('-t', '--date_tolerance', default='1d', help='how far apart the dates of the same match can be')
+    args = parser.parse_args()
+    main(args.old, args.new, args.output_dir, args.date_tolerance)
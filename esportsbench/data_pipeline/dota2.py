@@ -2,7 +2,7 @@
 import json
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr
+from esportsbench.utils import is_null_or_empty
 
 
 class Dota2DataPipeline(LPDBDataPipeline):
@@ -28,12 +28,11 @@ class Dota2DataPipeline(LPDBDataPipeline):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
 
     def process_data(self):
-        df = pl.scan_ndjson(self.raw_data_dir / 'dota2.jsonl', infer_schema_length=200000).collect()
-        print(f'initial row count: {df.shape[0]}')
+        df = self.scan_raw('dota2.jsonl')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
-        too_early_expr = pl.col('date') < '2011-01-01'
+        too_early_expr = pl.col('date') < pl.datetime(2011, 1, 1)
         df = self.filter_invalid(df, too_early_expr, 'too_early')
 
         # filter out matches without exactly 2 teams
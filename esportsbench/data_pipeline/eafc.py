@@ -1,7 +1,31 @@
-import json
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr, outcome_from_scores
+from esportsbench.utils import is_null_or_empty
+
+
+def normalize_match2games(games):
+    """keep only the scores and the played participants of each game
+    participants come back as a dict keyed by '<opponent>_<player id>' or as an empty list when there are none
+    """
+    out_games = []
+    for game in games:
+        participants = game.get('participants')
+        played_participants = []
+        if isinstance(participants, dict):
+            for part, data in participants.items():
+                if isinstance(part, str) and ('_' in part):
+                    played = data.get('played') if isinstance(data, dict) else (len(participants) == 2)
+                    if played:
+                        opid, id = part.split('_')
+                        played_participants.append({'opponent': int(opid), 'id': int(id)})
+        scores = game.get('scores')
+        if not isinstance(scores, list):
+            scores = []
+        out_games.append({
+            'participants': played_participants,
+            'scores': [None if score is None else str(score) for score in scores],
+        })
+    return out_games
 
 
 class EAFCDataPipeline(LPDBDataPipeline):
@@ -10,7 +34,7 @@ class EAFCDataPipeline(LPDBDataPipeline):
     game = 'ea_sports_fc'
     version = 'v3'
     schema_overrides = {
-        'match2games': json.dumps,
+        'match2games': normalize_match2games,
         'match2opponents': LPDBDataPipeline.drop_opponent_extradata
     }
     request_params_groups = {
@@ -27,126 +51,76 @@ class EAFCDataPipeline(LPDBDataPipeline):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
 
 
-    @staticmethod
-    def parse_team(raw_team):
-        players = {}
-        for player in raw_team['match2players']:
-            players[player['id']] = player['name']
-        return players
-
-    @staticmethod
-    def parse_opponents(raw_opponents):
-        team_1 = EAFCDataPipeline.parse_team(raw_opponents[0])
-        team_2 = EAFCDataPipeline.parse_team(raw_opponents[1])
-        return [team_1, team_2]
-    
-    @staticmethod
-    def parse_participant_ids(participants):
-        out = [None, None]
-        for part, data in participants.items():
-            if isinstance(part, str) and ('_' in part):
-                played = data.get('played') if isinstance(data, dict) else (len(participants) == 2)
-                if played:
-                    opid, id = part.split('_')
-                    out[int(opid) - 1] = int(id)
-        return out
-
-
-    @staticmethod
-    def unpack_team_match(raw_data):
-        global COUNTER
-
-        raw_games = raw_data['match2games']
-        raw_opponents = raw_data['match2opponents']
-        opponents = EAFCDataPipeline.parse_opponents(raw_opponents)
-        if opponents[0] == {} or opponents[1] == {}:
-            return None
-
-        games = json.loads(raw_games)
-        outputs = []
-        for idx, game in enumerate(games):
-            if game['participants'] == []:
-                continue
-            if len(game['scores']) != 2:
-                continue
-            participant_ids = EAFCDataPipeline.parse_participant_ids(game['participants'])
-            if len(participant_ids) != 2:
-                continue
-
-            player_1_score, player_2_score = map(int, game['scores'])
-            outcome = outcome_from_scores(player_1_score, player_2_score)
-
-            player_1 = opponents[0].get(participant_ids[0])
-            player_2 = opponents[1].get(participant_ids[1])
-
-            if (player_1 is None) or (player_2 is None):
-                continue
-            outputs.append(
-                {
-                    'player_1': player_1,
-                    'player_2': player_2,
-                    'player_1_score': float(player_1_score),
-                    'player_2_score': float(player_2_score),
-                    'outcome': outcome,
-                    'game_idx': idx,
-                }
-            )
-
-        return outputs
-
     def unpack_team_matches(self, team_df):
-
-        team_match_struct = pl.Struct([
-            pl.Field("player_1", pl.Utf8),
-            pl.Field("player_2", pl.Utf8),
-            pl.Field("player_1_score", pl.Float64),
-            pl.Field("player_2_score", pl.Float64),
-            pl.Field("outcome", pl.Float64),
-            pl.Field("game_idx", pl.Int64),
-        ])
-
-        # first combine match2games and match2games into a single col
-        team_df = team_df.with_columns(
-             pl.struct(['match2opponents', 'match2games']).alias("match2data")
-        )
-
-        team_df = team_df.with_columns(
-            pl.col('match2data').map_elements(
-                function=self.unpack_team_match,
-                skip_nulls=True,
-                return_dtype=pl.List(team_match_struct)
-            ).alias('games')
+        """one row per 1v1 game played within team matches, match2games must be stored by normalize_match2games"""
+        if team_df.collect_schema()['match2games'] == pl.Utf8:
+            raise ValueError('match2games is stored as a json string, regenerate the raw data with --action rebuild')
+
+        team_df = self.filter_empty_team_games(team_df).with_row_index('match_idx')
+        games_df = (
+            team_df.explode('match2games')
+            .with_columns(pl.int_range(pl.len()).over('match_idx').alias('game_idx'))
         )
+        participants = pl.col('match2games').struct.field('participants')
+        for opp_idx in (1, 2):
+            # the last played participant of each opponent is the player for that game
+            games_df = games_df.with_columns(
+                participants.list.eval(
+                    pl.element().filter(pl.element().struct.field('opponent') == opp_idx).struct.field('id')
+                ).list.last().alias(f'player_{opp_idx}_id')
+            )
+            # player id -> name for the team, like a dict later players with the same id win
+            team_players = (
+                team_df.select(
+                    'match_idx',
+                    pl.col('match2opponents').list.get(opp_idx - 1).struct.field('match2players').alias('player'),
+                )
+                .explode('player')
+                .select(
+                    'match_idx',
+                    pl.col('player').struct.field('id').cast(pl.Int64, strict=False).alias(f'player_{opp_idx}_id'),
+                    pl.col('player').struct.field('name').alias(f'player_{opp_idx}_name'),
+                )
+                .drop_nulls(f'player_{opp_idx}_id')
+                .unique(['match_idx', f'player_{opp_idx}_id'], keep='last', maintain_order=True)
+            )
+            games_df = games_df.join(
+                team_players, on=['match_idx', f'player_{opp_idx}_id'], how='left', maintain_order='left'
+            )
 
-        games_df = team_df.explode('games').unnest('games')
-        bad_team_game_expr = (
-            is_null_or_empty(pl.col('player_1'))
-            | is_null_or_empty(pl.col('player_2'))
-            | is_null_or_empty(pl.col('player_1_score'))
-            | is_null_or_empty(pl.col('player_2_score'))
-            | (pl.col('player_1_score') == -1)
-            | (pl.col('player_2_score') == -1)
-        )
-        games_df = self.filter_invalid(games_df, bad_team_game_expr, 'bad_team_game')
+        scores = pl.col('match2games').struct.field('scores')
+        player_1_score = scores.list.get(0, null_on_oob=True).cast(pl.Int64, strict=False).cast(pl.Float64)
+        player_2_score = scores.list.get(1, null_on_oob=True).cast(pl.Int64, strict=False).cast(pl.Float64)
 
-        games_df = games_df.with_columns(
-            pl.col('player_1_score').cast(pl.Float64).alias('player_1_score'),
-            pl.col('player_2_score').cast(pl.Float64).alias('player_2_score'),
-            pl.concat_str([pl.col('match2id'), pl.col('game_idx').cast(pl.Utf8)], separator='_').alias('match2id'),
+        keep_expr = (
+            (scores.list.len() == 2)
+            & pl.col('player_1_name').is_not_null()
+            & pl.col('player_2_name').is_not_null()
         )
-
-        return games_df
+        game_exprs = [
+            pl.col('player_1_name').alias('player_1'),
+            pl.col('player_2_name').alias('player_2'),
+            player_1_score.alias('player_1_score'),
+            player_2_score.alias('player_2_score'),
+            pl.when(player_1_score > player_2_score)
+            .then(1.0)
+            .when(player_1_score < player_2_score)
+            .then(0.0)
+            .otherwise(0.5)
+            .alias('outcome'),
+            pl.col('game_idx'),
+        ]
+        games_df = self.filter_team_games(games_df, keep_expr, game_exprs)
+        return games_df.drop('player_1_id', 'player_2_id', 'player_1_name', 'player_2_name')
 
     def process_data(self):
-        df = pl.read_ndjson(
-            self.raw_data_dir / 'ea_sports_fc.jsonl',
-            infer_schema_length=100000,
+        df = self.scan_raw(
+            'ea_sports_fc.jsonl',
             ignore_errors=False
         )
 
-        print(f'initial row count: {df.shape[0]}')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         # filter out matches without exactly 2 teams
         not_two_players_expr = pl.col('match2opponents').list.len() != 2
@@ -160,8 +134,6 @@ class EAFCDataPipeline(LPDBDataPipeline):
         team_df = df.filter(team_expr)
         
         df = df.filter(~team_expr)
-        print(f'num initial 1v1 matches: {len(df)}')
-        print(f'num initial team matches: {len(team_df)}')
 
 
         # extract player names and scores
@@ -232,14 +204,12 @@ class EAFCDataPipeline(LPDBDataPipeline):
         # df = pl.concat([df, team_games], how='diagonal')
         # print(f'matches after merging: {len(df)}')
 
-        # team_df = self.filter_invalid(team_matches, invalid_date_expr, 'invalid_date_team')
+        # team_df = self.filter_invalid_dates(team_matches, 'invalid_date_team')
         # print(f'initial team match row count: {team_matches.shape[0]}')
 
         team_matches = self.unpack_team_matches(team_df)
-        print(f'1v1 matches from team matches: {len(team_matches)}')
 
         df = pl.concat([df, team_matches], how='diagonal')
-        print(f'matches after merging: {len(df)}')
 
         played_self_expr = pl.col('player_1') == pl.col('player_2')
         df = self.filter_invalid(df, played_self_expr, 'played_self')
@@ -1,6 +1,5 @@
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import invalid_date_expr
 
 # info from https://liquipedia.net/fighters/Module:Info alphabetical order
 GAME_CONFIG = {
@@ -67,28 +66,39 @@ GAME_CONFIG = {
 
 
 class FightingGamesDataPipeline(LPDBDataPipeline):
-    """class for ingesting and processing raw fighting game data from LPDB"""
+    """class for ingesting and processing raw fighting game data from LPDB
+    every game shares one raw file, it is processed once and split into one output per game in games
+    """
 
     game = 'fighting_games'
     version = 'v1'
     request_params_groups = {
         f'{game}.jsonl': {
             'wiki': 'fighters',
-            'query': 'date, opponent1, opponent2, opponent1score, opponent2score, winner, game, matchid, pagename, objectname, extradata',
-            'conditions': '[[walkover::!1]] AND [[walkover::!2]] AND [[mode::singles]] AND [[opponent1::!Bye]] AND [[opponent2::!Bye]]',
+            'query': (
+                'date, opponent1, opponent2, opponent1score, opponent2score, winner, game, matchid, pagename, '
+                'objectname, extradata'
+            ),
+            'conditions': (
+                '[[walkover::!1]] AND [[walkover::!2]] AND [[mode::singles]] '
+                'AND [[opponent1::!Bye]] AND [[opponent2::!Bye]]'
+            ),
             'order': 'date ASC, objectname ASC',
         }
     }
 
-    def __init__(self, rows_per_request=1000, timeout=60.0, game=None, **kwargs):
+    def __init__(self, rows_per_request=1000, timeout=60.0, game=None, games=None, **kwargs):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
-        self.game = game
+        if games is None:
+            games = [game] if game is not None else list(GAME_CONFIG)
+        self.games = games
+        if len(games) == 1:
+            self.game = games[0]
 
     def process_data(self):
-        df = pl.scan_ndjson(self.raw_data_dir / 'fighting_games.jsonl', infer_schema_length=200000).collect()
-        print(f'initial row count: {df.shape[0]}')
+        df = self.scan_raw('fighting_games.jsonl')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         df = df.with_columns(
             pl.when(pl.col('winner') == pl.col('opponent1'))
@@ -119,4 +129,7 @@ class FightingGamesDataPipeline(LPDBDataPipeline):
             .unique()
             .sort('date', 'match_id')
         )
-        return df.filter(pl.col('game').is_in(GAME_CONFIG[self.game]))
+        return df.filter(pl.col('game').is_in(set.union(*(GAME_CONFIG[game] for game in self.games))))
+
+    def get_outputs(self, df):
+        return {game: df.filter(pl.col('game').is_in(GAME_CONFIG[game])) for game in self.games}
@@ -1,5 +1,7 @@
 """main script for ingesting data from various sources"""
 import argparse
+import os
+import time
 from functools import partial
 from multiprocessing import Pool
 from operator import methodcaller
@@ -21,7 +23,8 @@ from esportsbench.data_pipeline.tetris import TetrisDataPipeline
 from esportsbench.data_pipeline.fighting_games import FightingGamesDataPipeline
 from esportsbench.data_pipeline.eafc import EAFCDataPipeline
 from esportsbench.data_pipeline.postprocess import postprocess
-from esportsbench.utils import delimited_list
+from esportsbench.data_pipeline.snapshot import make_and_compare
+from esportsbench.utils import delimited_list, polars_pool
 from esportsbench.arg_parsers import get_games_argparser
 
 GAME_CLASS_MAP = {
@@ -47,8 +50,46 @@ GAME_CLASS_MAP = {
     'eafc' : EAFCDataPipeline,
 }
 
+FIGHTING_GAMES = {'sf', 'tek', 'kof', 'gg'}
 
-def run_pipeline(games, action, num_processes=1, **kwargs):
+
+def process_pipelines(data_pipelines, num_processes=1, memory_budget_gb=None):
+    """run process_and_write for each pipeline, the ones with the most raw data start first
+    up to num_processes run at once as long as their estimated memory fits in the budget, a game that
+    is bigger than the whole budget still runs, just on its own
+    """
+    costs = {id(data_pipeline): data_pipeline.estimate_process_memory() for data_pipeline in data_pipelines}
+    pending = sorted(data_pipelines, key=lambda data_pipeline: costs[id(data_pipeline)], reverse=True)
+    if num_processes <= 1:
+        list(map(methodcaller('process_and_write'), pending))
+        return
+
+    if memory_budget_gb is None:
+        memory_budget = 0.75 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    else:
+        memory_budget = memory_budget_gb * (1024 ** 3)
+
+    # terminates the workers on the way out, so a game which raises doesn't leave the others running
+    with polars_pool(num_processes) as pool:
+        running = []  # (async result, cost)
+        while (len(pending) > 0) or (len(running) > 0):
+            memory_in_use = sum(cost for _, cost in running)
+            for data_pipeline in list(pending):
+                if len(running) >= num_processes:
+                    break
+                cost = costs[id(data_pipeline)]
+                if (len(running) == 0) or (memory_in_use + cost <= memory_budget):
+                    print(f'processing {data_pipeline.game}, estimated memory: {cost / (1024 ** 3):.2f}GB')
+                    running.append((pool.apply_async(data_pipeline.process_and_write), cost))
+                    memory_in_use += cost
+                    pending.remove(data_pipeline)
+            time.sleep(0.1)
+            for result, cost in [item for item in running if item[0].ready()]:
+                result.get()  # raises if the game failed
+                running.remove((result, cost))
+
+
+def run_pipeline(games, action, num_processes=1, memory_budget_gb=None, **kwargs):
     """run ingenstion and/or processing for the specified games"""
     if num_processes > 1:
         pool = Pool(num_processes)
@@ -56,7 +97,11 @@ def run_pipeline(games, action, num_processes=1, **kwargs):
     else:
         map_fn = map
 
-    data_pipelines = [GAME_CLASS_MAP[game](**kwargs) for game in games]
+    # every fighting game comes from the same raw data so one pipeline ingests and processes them together
+    fighting_games = [GAME_CLASS_MAP[game].keywords['game'] for game in games if game in FIGHTING_GAMES]
+    data_pipelines = [GAME_CLASS_MAP[game](**kwargs) for game in games if game not in FIGHTING_GAMES]
+    if len(fighting_games) > 0:
+        data_pipelines.append(FightingGamesDataPipeline(games=fighting_games, **kwargs))
     if action in {'ingest', 'all'}:
         list(map_fn(methodcaller('ingest_data'), data_pipelines))
 
@@ -64,8 +109,17 @@ def run_pipeline(games, action, num_processes=1, **kwargs):
         pool.close()
         pool.join()
 
+    if action == 'rebuild':
+        list(map(methodcaller('rebuild_raw_from_cache', num_processes=num_processes), data_pipelines))
+
+    if action == 'schema':
+        list(map(methodcaller('learn_raw_schemas'), data_pipelines))
+
     if action in {'process', 'all'}:
-        list(map(methodcaller('process_and_write'), data_pipelines))
+        process_pipelines(data_pipelines, num_processes=num_processes, memory_budget_gb=memory_budget_gb)
+
+    if kwargs.get('snapshot'):
+        make_and_compare(write=True)
 
     if kwargs['postprocess']:
         postprocess(
@@ -81,17 +135,49 @@ if __name__ == '__main__':
         '--action',
         type=str,
         required=False,
-        choices=['ingest', 'process', 'all'],
+        choices=['ingest', 'rebuild', 'schema', 'process', 'all'],
         default='all',
     )
     parser.add_argument('-t', '--timeout', type=float, required=False)
     parser.add_argument('-mr', '--max_rows', type=int, required=False)
     parser.add_argument('-kr', '--keys_to_refresh', type=delimited_list, required=False, default=[])
     parser.add_argument('-np', '--num_processes', type=int, required=False, default=1)
+    parser.add_argument(
+        '-nw', '--num_workers', type=int, required=False, help='number of pages to fetch concurrently per request group'
+    )
+    parser.add_argument('-r', '--resume', action='store_true', help='resume ingestion from the last checkpointed page')
+    parser.add_argument(
+        '-inc', '--incremental', action='store_true', help='only fetch LPDB matches newer than the raw data watermark'
+    )
+    parser.add_argument(
+        '--overlap_days', type=int, required=False, help='days before the watermark to re-fetch in incremental mode'
+    )
+    parser.add_argument(
+        '-rf', '--raw_format', type=str, required=False, choices=['jsonl', 'arrow'], help='storage format for raw data'
+    )
+    parser.add_argument(
+        '-ip',
+        '--incremental_process',
+        action='store_true',
+        help='only process raw pages which changed since the last run and merge into the full data',
+    )
+    parser.add_argument(
+        '-mb',
+        '--memory_budget_gb',
+        type=float,
+        required=False,
+        help='memory budget for processing games in parallel, defaults to 75%% of RAM',
+    )
+    parser.add_argument(
+        '-srl', '--shared_rate_limit', action='store_true', help='share one request budget per host across processes'
+    )
     parser.add_argument('--train_end_date', type=str, default='2023-03-31', help='inclusive end date for test set')
     parser.add_argument('--test_end_date', type=str, default='2024-03-31', help='inclusive end date for test set')
     parser.add_argument('--min_rows_year', type=int, default=100, help='minimum number of rows in a year to begin including data')
     parser.add_argument('--postprocess', '-p', action='store_true')
+    parser.add_argument(
+        '--snapshot', '-s', action='store_true', help='snapshot the full data and compare it to the previous snapshot'
+    )
     args = vars(parser.parse_args())
     args = {key: val for key, val in args.items() if val is not None}
     run_pipeline(**args)
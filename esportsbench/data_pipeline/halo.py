@@ -1,6 +1,6 @@
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr
+from esportsbench.utils import is_null_or_empty
 
 
 class HaloDataPipeline(LPDBDataPipeline):
@@ -23,8 +23,7 @@ class HaloDataPipeline(LPDBDataPipeline):
     def process_data(self):
         """read data from raw jsonl, filter invalid data, process and write to final data  location"""
 
-        df = pl.scan_ndjson(self.raw_data_dir / 'halo.jsonl', infer_schema_length=50000).collect()
-        print(f'initial row count: {df.shape[0]}')
+        df = self.scan_raw('halo.jsonl')
 
         # filter out matches without exactly 2 teams
         not_two_teams_expr = pl.col('match2opponents').list.len() != 2
@@ -149,7 +148,7 @@ class HaloDataPipeline(LPDBDataPipeline):
         played_self_expr = pl.col('team_1') == pl.col('team_2')
         df = self.filter_invalid(df, played_self_expr, 'played_self')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         # select final columns and write to csv
         df = (
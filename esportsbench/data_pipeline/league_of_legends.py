@@ -10,6 +10,7 @@ class LeaugeOfLegendsDataPipeline(DataPipeline):
     """class to ingest and process data from leaguepedia"""
 
     game = 'league_of_legends'
+    raw_date_col = 'DateTime UTC'
     base_url = 'https://lol.fandom.com/api.php?'
     request_params_groups = {
         'league_of_legends.jsonl': {
@@ -73,8 +74,9 @@ class LeaugeOfLegendsDataPipeline(DataPipeline):
 
     def process_data(self):
         """function to process the raw data"""
-        df = pl.scan_ndjson(self.raw_data_dir / 'league_of_legends.jsonl', infer_schema_length=1).collect()
-        print(f'initial row count: {df.shape[0]}')
+        df = self.scan_raw('league_of_legends.jsonl').rename({'DateTime UTC': 'date'})
+
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         # Apply redirect logic with fallback chain
         df = df.with_columns(
@@ -117,7 +119,7 @@ class LeaugeOfLegendsDataPipeline(DataPipeline):
 
         df = (
             df.select(
-                pl.col('DateTime UTC').alias('date'),
+                'date',
                 pl.col('Team1').alias('competitor_1'),
                 pl.col('Team2').alias('competitor_2'),
                 pl.col('Team1Score').cast(pl.Float64, strict=False).fill_null(-1).alias('competitor_1_score'),
@@ -1,6 +1,6 @@
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr
+from esportsbench.utils import is_null_or_empty
 
 
 class OverwatchDataPipeline(LPDBDataPipeline):
@@ -25,11 +25,10 @@ class OverwatchDataPipeline(LPDBDataPipeline):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
 
     def process_data(self):
-        df = pl.read_ndjson(self.raw_data_dir / 'overwatch.jsonl', infer_schema_length=100000)
+        df = self.scan_raw('overwatch.jsonl')
         
-        print(f'initial row count: {df.shape[0]}')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         # filter out matches without exactly 2 teams
         not_two_teams_expr = pl.col('match2opponents').list.len() != 2
@@ -1,86 +1,118 @@
 import os
 import argparse
-from datetime import datetime
+from datetime import date
 import polars as pl
 import pathlib
 from esportsbench.constants import GAME_NAME_MAP
+from esportsbench.utils import parsed_date_expr, polars_pool
 
 pl.Config.set_tbl_rows(100)
 
 
-def postprocess(train_end_date, test_end_date, min_rows_year, version):
-    data_dir = pathlib.Path(__file__).resolve().parents[2] / 'data'
-    input_file_paths = sorted(data_dir.glob('full_data/parquet/*'))
-    print('')
-    for input_file_path in input_file_paths:
-        game = input_file_path.stem
-        print(f'summary for {game}:')
-        df = pl.read_parquet(input_file_path).drop('competitor_1_score', 'competitor_2_score')
-        if 'game' in df.columns:
-            df = df.drop('game')
-        print(f'num total matches: {len(df)}')
-        first_date = df.select('date').min().item()[:10]
-        last_date = df.select('date').max().item()[:10]
-        print(f'input date range: {first_date} to {last_date}')
-
-        comp_1_error = df.select('competitor_1').filter(pl.col('competitor_1').str.contains('<div class="error">')).count().item()
-        comp_2_error = df.select('competitor_2').filter(pl.col('competitor_2').str.contains('<div class="error">')).count().item()
-
-        print(f'comp_1 error count: {comp_1_error}')
-        print(f'comp_2 error count: {comp_2_error}')
-
-        df = df.with_columns(pl.col('date').str.to_datetime().alias('date'))
-        df = df.with_columns(pl.col('date').dt.year().alias('year'))
-        year_counts = df.group_by('year').len().sort('year')
-        first_valid_year = year_counts.filter(
-            pl.col('len') >= min_rows_year
-        ).select('year').min().item()
-        print(f'first year with at least {min_rows_year} rows: {first_valid_year}')
-        df = df.with_columns(
-            pl.col('date').dt.date().cast(pl.Utf8).alias('date')
-        )
-        future_df = df.filter(pl.col('date') > datetime.today().strftime("%Y-%m-%d"))
-        print('num future matches:', len(future_df))
+def postprocess_game(input_file_path, output_dir, train_end_date, test_end_date, min_rows_year):
+    """filter one game's full data down to the final data and return the summary lines for it
+    the input stats are one aggregation over a by-year groupby of the columns they need,
+    the output stats and both output files then come from a single scan of the filtered plan
+    """
+    game = input_file_path.stem
+    lines = [f'summary for {game}:']
+    df = pl.scan_parquet(input_file_path)
+    columns = df.collect_schema()
+    df = df.drop('competitor_1_score', 'competitor_2_score', *(['game'] if 'game' in columns else []))
+    if columns['date'] == pl.Utf8:
+        # full data written before dates were parsed at process time
+        df = df.with_columns(parsed_date_expr.alias('date'))
+    df = df.with_columns(pl.col('date').dt.date().alias('date'))
 
-        df = df.filter(
-            (pl.col('year') >= first_valid_year)
-            & (pl.col('date') <= test_end_date)
+    error_expr = lambda col: pl.col(col).str.contains('<div class="error">').sum()
+    years = (
+        df.group_by(pl.col('date').dt.year().alias('year'))
+        .agg(
+            pl.len(),
+            pl.col('date').min().alias('first_date'),
+            pl.col('date').max().alias('last_date'),
+            error_expr('competitor_1').alias('comp_1_errors'),
+            error_expr('competitor_2').alias('comp_2_errors'),
+            (pl.col('date') > date.today()).sum().alias('num_future'),
         )
-        print(df.columns)
-        print(f'filtered row count: {len(df)}')
-        unique_competitors = pl.concat([
-            df["competitor_1"],
-            df["competitor_2"]
-        ]).unique()
-        print(f'num unique competitors: {unique_competitors.count()}')
+        .collect()
+    )
+    input_stats = years.select(
+        pl.col('len').sum(),
+        pl.col('first_date').min(),
+        pl.col('last_date').max(),
+        pl.col('comp_1_errors').sum(),
+        pl.col('comp_2_errors').sum(),
+        pl.col('num_future').sum(),
+        pl.col('year').filter(pl.col('len') >= min_rows_year).min().alias('first_valid_year'),
+    ).row(0, named=True)
+    first_valid_year = input_stats['first_valid_year']
+    lines.append(f'num total matches: {input_stats["len"]}')
+    lines.append(f'input date range: {input_stats["first_date"]} to {input_stats["last_date"]}')
+    lines.append(f'comp_1 error count: {input_stats["comp_1_errors"]}')
+    lines.append(f'comp_2 error count: {input_stats["comp_2_errors"]}')
+    lines.append(f'first year with at least {min_rows_year} rows: {first_valid_year}')
+    lines.append(f'num future matches: {input_stats["num_future"]}')
 
-        draw_rate = df.select(pl.col('outcome')== 0.5).mean().item()
-        print(f'Draw rate: {draw_rate}')
-        print(f'mean outcome: {df.select("outcome").mean().item()}')
-        first_date = df.select('date').min().item()[:10]
-        last_date = df.select('date').max().item()[:10]
-        print(f'output date range: {first_date} to {last_date}')
+    df = df.filter(
+        (pl.col('date').dt.year() >= first_valid_year)
+        & (pl.col('date') <= test_end_date)
+    ).cache()
+    output_stats = df.select(
+        pl.len(),
+        pl.col('competitor_1').append(pl.col('competitor_2')).n_unique().alias('num_competitors'),
+        (pl.col('outcome') == 0.5).mean().alias('draw_rate'),
+        pl.col('outcome').mean().alias('mean_outcome'),
+        pl.col('date').min().alias('first_date'),
+        pl.col('date').max().alias('last_date'),
+        (pl.col('date') <= train_end_date).sum().alias('num_train'),
+        (pl.col('date') > train_end_date).sum().alias('num_test'),
+    )
+    output_csv_path = output_dir / 'csv' / f'{game}.csv'
+    output_parquet_path = output_dir / 'parquet' / f'{game}.parquet'
+    output_stats, *_ = pl.collect_all(
+        [
+            output_stats,
+            df.sink_csv(output_csv_path, lazy=True),
+            df.sink_parquet(output_parquet_path, lazy=True),
+        ]
+    )
+    output_stats = output_stats.row(0, named=True)
+    lines.append(str(df.collect_schema().names()))
+    lines.append(f'filtered row count: {output_stats["len"]}')
+    lines.append(f'num unique competitors: {output_stats["num_competitors"]}')
+    lines.append(f'Draw rate: {output_stats["draw_rate"]}')
+    lines.append(f'mean outcome: {output_stats["mean_outcome"]}')
+    lines.append(f'output date range: {output_stats["first_date"]} to {output_stats["last_date"]}')
+    lines.append(f'num train rows: {output_stats["num_train"]}')
+    lines.append(f'num test rows: {output_stats["num_test"]}')
+    lines.append('======================================================')
+    return '\n'.join(lines)
 
-        train_df = df.filter(
-            (pl.col('date') <= train_end_date)
-        )
-        test_df = df.filter(
-            (pl.col('date') > train_end_date)
-            & (pl.col('date') <= test_end_date)
-        )
 
-        print(f'num train rows: {len(train_df)}')
-        print(f'num test rows: {len(test_df)}')
+def postprocess(train_end_date, test_end_date, min_rows_year, version, num_processes=1):
+    train_end_date = date.fromisoformat(train_end_date)
+    test_end_date = date.fromisoformat(test_end_date)
+    data_dir = pathlib.Path(__file__).resolve().parents[2] / 'data'
+    input_file_paths = sorted(data_dir.glob('full_data/parquet/*'))
+    output_dir = data_dir / f'final_data_v{version}'
+    os.makedirs(output_dir / 'csv', exist_ok=True)
+    os.makedirs(output_dir / 'parquet', exist_ok=True)
+    game_args = [
+        (input_file_path, output_dir, train_end_date, test_end_date, min_rows_year)
+        for input_file_path in input_file_paths
+    ]
+    print('')
+    if num_processes <= 1:
+        for summary in map(postprocess_game, *zip(*game_args)):
+            print(summary)
+        return
 
-        output_dir = data_dir / f'final_data_v{version}'
-        os.makedirs(output_dir / 'csv', exist_ok=True)
-        os.makedirs(output_dir / 'parquet', exist_ok=True)
-        output_csv_path = output_dir / 'csv' / f'{game}.csv'
-        output_parquet_path = output_dir / 'parquet' / f'{game}.parquet'
-        df = df.drop('year')
-        df.write_csv(output_csv_path)
-        df.write_parquet(output_parquet_path)
-        print('======================================================')
+    with polars_pool(num_processes) as pool:
+        results = [pool.apply_async(postprocess_game, game_arg) for game_arg in game_args]
+        # summaries are printed here in game order so the output of different games doesn't interleave
+        for result in results:
+            print(result.get())
 
 
 if __name__ == '__main__':
@@ -89,5 +121,6 @@ if __name__ == '__main__':
     parser.add_argument('--test_end_date', type=str, default='2026-06-30', help='inclusive end date for test set')
     parser.add_argument('--min_rows_year', type=int, default=100, help='minmum number of rows in a year to begin including data')
     parser.add_argument('--version', '-v', type=str, default='10', help='which version of the dataset')
+    parser.add_argument('--num_processes', '-np', type=int, default=os.cpu_count(), help='number of games to postprocess at once')
     args = vars(parser.parse_args())
     postprocess(**args)
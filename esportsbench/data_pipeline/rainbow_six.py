@@ -1,7 +1,7 @@
 """classes and functions for ingesting and processing rainbow six data"""
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr
+from esportsbench.utils import is_null_or_empty
 
 
 class RainbowSixDataPipeline(LPDBDataPipeline):
@@ -27,15 +27,13 @@ class RainbowSixDataPipeline(LPDBDataPipeline):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
 
     def process_data(self):
-        df = pl.read_ndjson(
-            self.raw_data_dir / 'rainbow_six.jsonl',
-            infer_schema_length=89000,
+        df = self.scan_raw(
+            'rainbow_six.jsonl',
             ignore_errors=False
         )
 
-        print(f'initial row count: {df.shape[0]}')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         # filter out matches without exactly 2 teams
         not_two_teams_expr = pl.col('match2opponents').list.len() != 2
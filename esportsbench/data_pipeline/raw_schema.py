@@ -0,0 +1,61 @@
+"""
+Explicit polars schemas for the raw data of each request group
+Schemas are learned from the whole raw file in one pass, persisted as json and reused
+so reading raw data needs no inference
+"""
+
+import json
+import os
+
+import polars as pl
+
+
+def dtype_to_json(dtype):
+    if isinstance(dtype, pl.Struct):
+        return {'struct': {field.name: dtype_to_json(field.dtype) for field in dtype.fields}}
+    if isinstance(dtype, pl.List):
+        return {'list': dtype_to_json(dtype.inner)}
+    return str(dtype.base_type())
+
+
+def dtype_from_json(obj):
+    if isinstance(obj, dict) and ('struct' in obj):
+        return pl.Struct([pl.Field(name, dtype_from_json(inner)) for name, inner in obj['struct'].items()])
+    if isinstance(obj, dict) and ('list' in obj):
+        return pl.List(dtype_from_json(obj['list']))
+    return getattr(pl, obj)
+
+
+def read_schema(path):
+    with open(path) as f:
+        return {name: dtype_from_json(obj) for name, obj in json.load(f).items()}
+
+
+def write_schema(path, schema):
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({name: dtype_to_json(dtype) for name, dtype in schema.items()}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def schema_drift(old, new, prefix=''):
+    """list of human readable differences between two schemas, descends into structs and lists"""
+    changes = []
+    for name, dtype in new.items():
+        if name not in old:
+            changes.append(f'added {prefix}{name}: {dtype}')
+            continue
+        old_dtype = old[name]
+        if isinstance(old_dtype, pl.List) and isinstance(dtype, pl.List):
+            old_dtype, dtype = old_dtype.inner, dtype.inner
+            name = f'{name}[]'
+        if isinstance(old_dtype, pl.Struct) and isinstance(dtype, pl.Struct):
+            old_fields = {field.name: field.dtype for field in old_dtype.fields}
+            new_fields = {field.name: field.dtype for field in dtype.fields}
+            changes.extend(schema_drift(old_fields, new_fields, prefix=f'{prefix}{name}.'))
+        elif old_dtype != dtype:
+            changes.append(f'changed {prefix}{name}: {old_dtype} -> {dtype}')
+    for name in old:
+        if name not in new:
+            changes.append(f'removed {prefix}{name}')
+    return changes
@@ -0,0 +1,245 @@
+"""
+Storage for the raw data written during ingestion
+JsonlRawStore writes one newline delimited json file per request group
+ArrowRawStore writes zstd compressed arrow shards per request group which can be scanned with column projection
+Positions are where a store can be truncated to and resumed from, byte offsets for jsonl and shard counts for arrow
+"""
+
+import io
+import json
+import os
+import shutil
+
+import polars as pl
+
+
+def next_line_start(f, position):
+    """byte position of the first line which starts at or after position"""
+    if position == 0:
+        return 0
+    f.seek(position - 1)
+    f.readline()
+    return f.tell()
+
+
+def read_last_line(f, size, chunk_size=1 << 16):
+    position = size
+    while True:
+        position = max(0, position - chunk_size)
+        f.seek(position)
+        data = f.read(size - position).rstrip(b'\n')
+        idx = data.rfind(b'\n')
+        if (idx >= 0) or (position == 0):
+            return data[idx + 1:]
+
+
+def find_date_position(f, size, cutoff):
+    """binary search a raw file ordered by date for the start of the first row with date > cutoff"""
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        line_start = next_line_start(f, mid)
+        if (line_start >= size) or (json.loads(f.readline())['date'] > cutoff):
+            hi = mid
+        else:
+            lo = mid + 1
+    return next_line_start(f, lo)
+
+
+class JsonlRawStore:
+    """raw rows as newline delimited json"""
+
+    memory_factor = 2.0  # rough bytes of memory needed to process per byte on disk
+
+    def __init__(self, path):
+        self.path = path
+        self.out_file = None
+
+    def exists(self):
+        return self.path.exists() and (self.path.stat().st_size > 0)
+
+    def can_resume_from(self, position):
+        return self.path.exists() and (self.path.stat().st_size >= position)
+
+    def encode_page(self, rows):
+        return ''.join(json.dumps(row) + '\n' for row in rows)
+
+    def open(self, position=0):
+        """open for writing, everything after position is discarded"""
+        if (position == 0) or (not self.path.exists()):
+            self.path.write_text('')
+        os.truncate(self.path, position)
+        # truncated before opening so there's nothing left to fail with the handle open
+        self.out_file = self.path.open('a', encoding='utf8')
+
+    def write_page(self, page):
+        self.out_file.write(page)
+        self.out_file.flush()
+
+    def commit(self):
+        """returns the position everything written so far can be resumed from"""
+        return self.out_file.tell()
+
+    def close(self):
+        self.out_file.close()
+        self.out_file = None
+
+    def max_date(self):
+        with open(self.path, 'rb') as f:
+            return json.loads(read_last_line(f, self.path.stat().st_size))['date']
+
+    def position_after_date(self, cutoff):
+        """position of the first row with date > cutoff, rows must be ordered by date"""
+        with open(self.path, 'rb') as f:
+            return find_date_position(f, self.path.stat().st_size, cutoff)
+
+    def replace(self, other):
+        """move another store's data into this one"""
+        os.replace(other.path, self.path)
+
+    def remove(self):
+        if self.path.exists():
+            os.remove(self.path)
+
+    def mtime(self):
+        return self.path.stat().st_mtime if self.path.exists() else 0.0
+
+    def size(self):
+        return self.path.stat().st_size if self.path.exists() else 0
+
+    def learn_schema(self):
+        """schema of every row in the file, this is one pass over the file"""
+        return dict(pl.scan_ndjson(self.path, infer_schema_length=None).collect_schema())
+
+    def scan(self, **kwargs):
+        return pl.scan_ndjson(self.path, **kwargs)
+
+
+class ArrowRawStore:
+    """raw rows as zstd compressed arrow ipc shards of pages_per_shard pages each
+    arrow rather than parquet since LPDB returns lots of empty structs which parquet can't represent
+    each shard is cast to be a superset of the schema of the ones before it so the group schema only ever grows
+    """
+
+    memory_factor = 8.0  # shards are compressed so they expand a lot more than json when processed
+
+    def __init__(self, path, pages_per_shard=50):
+        self.path = path
+        self.pages_per_shard = pages_per_shard
+        self.num_shards = 0
+        self.schema = {}
+        self.buffer = []
+
+    def shard_paths(self):
+        if not self.path.exists():
+            return []
+        return sorted(self.path.glob('*.arrow'))
+
+    def exists(self):
+        return len(self.shard_paths()) > 0
+
+    def can_resume_from(self, position):
+        return len(self.shard_paths()) >= position
+
+    def encode_page(self, rows):
+        if len(rows) == 0:
+            return None
+        # go through the ndjson reader so types are inferred the same way as for the jsonl store
+        text = ''.join(json.dumps(row) + '\n' for row in rows)
+        return pl.read_ndjson(io.StringIO(text), infer_schema_length=None)
+
+    def open(self, position=0):
+        """open for writing, every shard from position on is discarded"""
+        os.makedirs(self.path, exist_ok=True)
+        shard_paths = self.shard_paths()
+        for shard_path in shard_paths[position:]:
+            os.remove(shard_path)
+        self.num_shards = position
+        self.buffer = []
+        self.schema = {}
+        if position > 0:
+            self.schema = dict(pl.read_ipc_schema(shard_paths[position - 1]))
+
+    def write_page(self, page):
+        self.buffer.append(page)
+        if len(self.buffer) >= self.pages_per_shard:
+            self.flush()
+
+    def flush(self):
+        pages = [page for page in self.buffer if page is not None]
+        self.buffer = []
+        if len(pages) == 0:
+            return
+        df = pl.concat([pl.DataFrame(schema=self.schema)] + pages, how='diagonal_relaxed')
+        self.schema = dict(df.schema)
+        df.write_ipc(self.path / f'{self.num_shards:05d}.arrow', compression='zstd')
+        self.num_shards += 1
+
+    def commit(self):
+        """returns the position everything written so far can be resumed from, None if pages are still buffered"""
+        if len(self.buffer) > 0:
+            return None
+        return self.num_shards
+
+    def close(self):
+        self.flush()
+
+    def max_date(self):
+        return self.scan().select(pl.col('date').max()).collect().item()
+
+    def position_after_date(self, cutoff):
+        """shard position after which every row has date > cutoff, rows must be ordered by date
+        the shard straddling the cutoff is rewritten with only the rows up to the cutoff
+        """
+        for idx, shard_path in enumerate(self.shard_paths()):
+            shard = pl.read_ipc(shard_path)
+            if shard['date'].max() <= cutoff:
+                continue
+            kept = shard.filter(pl.col('date') <= cutoff)
+            if len(kept) == 0:
+                return idx
+            # write next to the shard and swap since the shard may still be memory mapped
+            tmp_path = shard_path.with_suffix('.tmp')
+            kept.write_ipc(tmp_path, compression='zstd')
+            os.replace(tmp_path, shard_path)
+            return idx + 1
+        return len(self.shard_paths())
+
+    def replace(self, other):
+        """move another store's data into this one"""
+        self.remove()
+        os.replace(other.path, self.path)
+
+    def remove(self):
+        if self.path.exists():
+            shutil.rmtree(self.path)
+
+    def mtime(self):
+        return max((shard_path.stat().st_mtime for shard_path in self.shard_paths()), default=0.0)
+
+    def size(self):
+        return sum(shard_path.stat().st_size for shard_path in self.shard_paths())
+
+    def learn_schema(self):
+        """shards are already typed so this only reads their schemas"""
+        if not self.exists():
+            return {}
+        return dict(self.scan().collect_schema())
+
+    def scan(self, schema=None, ignore_errors=False, infer_schema_length=None, low_memory=False):
+        """takes the scan_ndjson options pipelines pass through scan_raw, anything else is a TypeError
+        shards are typed when they are written so infer_schema_length and low_memory have nothing to do,
+        columns whose type in schema differs from the shards are cast, to null where that fails if ignore_errors
+        """
+        shard_paths = self.shard_paths()
+        if len(shard_paths) == 0:
+            return pl.LazyFrame(schema=schema)
+        df = pl.concat([pl.scan_ipc(shard_path) for shard_path in shard_paths], how='diagonal_relaxed')
+        if schema is not None:
+            shard_schema = df.collect_schema()
+            casts = {
+                col: dtype for col, dtype in schema.items() if (col in shard_schema) and (shard_schema[col] != dtype)
+            }
+            if len(casts) > 0:
+                df = df.cast(casts, strict=not ignore_errors)
+        return df
@@ -2,7 +2,7 @@
 import json
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr, debug_ndjson
+from esportsbench.utils import is_null_or_empty, debug_ndjson
 
 
 class RocketLeagueDataPipeline(LPDBDataPipeline):
@@ -30,14 +30,12 @@ class RocketLeagueDataPipeline(LPDBDataPipeline):
         #     infer_schema_length=200000,
         #     ignore_errors=True
         # ).collect()
-        df = pl.read_ndjson(
-            self.raw_data_dir / 'rocket_league.jsonl',
-            infer_schema_length=120_000,
+        df = self.scan_raw(
+            'rocket_league.jsonl',
             ignore_errors=True
         )
-        print(f'initial row count: {df.shape[0]}')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         # filter out matches without exactly 2 teams
         not_two_teams_expr = pl.col('match2opponents').list.len() != 2
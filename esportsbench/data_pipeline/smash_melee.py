@@ -1,6 +1,5 @@
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import invalid_date_expr
 
 
 class SmashMeleeDataPipeline(LPDBDataPipeline):
@@ -21,10 +20,9 @@ class SmashMeleeDataPipeline(LPDBDataPipeline):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
 
     def process_data(self):
-        df = pl.scan_ndjson(self.raw_data_dir / 'smash_melee.jsonl', infer_schema_length=1).collect()
-        print(f'initial row count: {df.shape[0]}')
+        df = self.scan_raw('smash_melee.jsonl')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         df = df.with_columns(
             pl.when(pl.col('winner') == pl.col('opponent1'))
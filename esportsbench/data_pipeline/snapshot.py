@@ -1,34 +1,145 @@
 import os
 import glob
 import pathlib
-from datetime import datetime
+import threading
+from datetime import date, datetime
 from argparse import ArgumentParser
 import polars as pl
 
 DATA_DIR = pathlib.Path(__file__).parents[2] / 'data'
 SNAPSHOT_DIR = DATA_DIR / 'snapshots'
 
-def make_snapshot_for_file(file_path):
+# custom parquet metadata written next to the full data so snapshots don't need to scan the data
+NUM_COMPETITORS_KEY = 'esportsbench.num_competitors'
+OUTCOME_SUM_KEY = 'esportsbench.outcome_sum'
+
+
+def snapshot_metadata(df):
+    """custom key value metadata for a full data parquet file, for data which is already in memory"""
+    stats = df.select(
+        pl.col('competitor_1').append(pl.col('competitor_2')).n_unique().alias('num_competitors'),
+        pl.col('outcome').sum().alias('outcome_sum'),
+    ).row(0, named=True)
+    return {NUM_COMPETITORS_KEY: str(stats['num_competitors']), OUTCOME_SUM_KEY: repr(stats['outcome_sum'])}
+
+
+class StreamingSnapshotStats:
+    """the same metadata as snapshot_metadata for data which is streamed to a sink, the batches are counted as they
+    pass through map_batches and the metadata callback runs once the sink has written the last batch, so only the
+    set of competitors is kept in memory
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.competitors = set()
+        self.outcome_sum = 0.0
+
+    def update(self, df):
+        competitors = set(df['competitor_1'].to_list()) | set(df['competitor_2'].to_list())
+        outcome_sum = df['outcome'].sum()
+        with self.lock:
+            self.competitors |= competitors
+            self.outcome_sum += outcome_sum
+        return df
+
+    def track(self, lf):
+        return lf.map_batches(self.update, streamable=True)
+
+    def metadata(self, _context=None):
+        return {NUM_COMPETITORS_KEY: str(len(self.competitors)), OUTCOME_SUM_KEY: repr(float(self.outcome_sum))}
+
+
+def footer_date_range(file_path):
+    """first and last date from the parquet row group statistics, None if the statistics weren't written"""
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_metadata(file_path)
+    date_idx = metadata.schema.names.index('date')
+    mins, maxs = [], []
+    for row_group_idx in range(metadata.num_row_groups):
+        stats = metadata.row_group(row_group_idx).column(date_idx).statistics
+        if (stats is None) or (not stats.has_min_max):
+            return None
+        mins.append(stats.min)
+        maxs.append(stats.max)
+    if len(mins) == 0:
+        return None
+    first_date, last_date = min(mins), max(maxs)
+    if isinstance(first_date, str):
+        # full data written before dates were parsed at process time
+        return date.fromisoformat(first_date[:10]), date.fromisoformat(last_date[:10])
+    return first_date.date(), last_date.date()
+
+
+def make_snapshot_for_file(file_path, full=False):
+    """row count and date range come from the parquet footer, competitors and outcomes from the custom metadata
+    if it was written and otherwise from a streaming pass over just those columns, full=True reads everything
+    """
     game_name = file_path.split('/')[-1].removesuffix('.parquet')
-    df = pl.read_parquet(file_path)
-    game_snapshot = df.select(
-        pl.lit(game_name).alias('game_name'),
-        pl.len().cast(pl.Int32).alias('num_matches'),
-        pl.concat([pl.col('competitor_1'), pl.col('competitor_2')]).unique().count().cast(pl.Int32).alias('num_competitors'),
-        pl.col('date').min().alias('first_date'),
-        pl.col('date').max().alias('last_date'),
-        pl.col('outcome').mean().alias('mean_outcome'),
+    if full:
+        df = pl.read_parquet(file_path)
+        if df.schema['date'] == pl.Utf8:
+            df = df.with_columns(pl.col('date').str.slice(0, 10).str.to_date('%Y-%m-%d'))
+        return df.select(
+            pl.lit(game_name).alias('game_name'),
+            pl.len().cast(pl.Int32).alias('num_matches'),
+            pl.concat([pl.col('competitor_1'), pl.col('competitor_2')]).unique().count().cast(pl.Int32).alias('num_competitors'),
+            pl.col('date').min().cast(pl.Date).alias('first_date'),
+            pl.col('date').max().cast(pl.Date).alias('last_date'),
+            pl.col('outcome').mean().alias('mean_outcome'),
+        )
+
+    df = pl.scan_parquet(file_path)
+    num_matches = df.select(pl.len()).collect().item()  # only reads the footer
+    date_range = footer_date_range(file_path)
+    if date_range is None:
+        # no row group statistics, eg an empty file, both are None if there are no rows
+        date_range = df.select(
+            pl.col('date').min().alias('min_date'),
+            pl.col('date').max().alias('max_date'),
+        ).collect().row(0)
+        if date_range[0] is not None:
+            if isinstance(date_range[0], str):
+                date_range = tuple(date.fromisoformat(value[:10]) for value in date_range)
+            elif isinstance(date_range[0], datetime):
+                date_range = tuple(value.date() for value in date_range)
+    metadata = pl.read_parquet_metadata(file_path)
+    if (NUM_COMPETITORS_KEY in metadata) and (OUTCOME_SUM_KEY in metadata):
+        num_competitors = int(metadata[NUM_COMPETITORS_KEY])
+        outcome_sum = float(metadata[OUTCOME_SUM_KEY])
+    else:
+        num_competitors, outcome_sum = df.select(
+            pl.col('competitor_1').append(pl.col('competitor_2')).n_unique(),
+            pl.col('outcome').sum(),
+        ).collect(engine='streaming').row(0)
+    return pl.DataFrame(
+        {
+            'game_name': [game_name],
+            'num_matches': [num_matches],
+            'num_competitors': [num_competitors],
+            'first_date': [date_range[0]],
+            'last_date': [date_range[1]],
+            'mean_outcome': [outcome_sum / num_matches if num_matches > 0 else None],
+        },
+        schema={
+            'game_name': pl.Utf8,
+            'num_matches': pl.Int32,
+            'num_competitors': pl.Int32,
+            'first_date': pl.Date,
+            'last_date': pl.Date,
+            'mean_outcome': pl.Float64,
+        },
     )
-    return game_snapshot
 
-def make_snapshot(write=False):
+def make_snapshot(write=False, full=False):
     name = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     game_snapshots = []
     for file in glob.glob(f'{DATA_DIR}/full_data/parquet/*.parquet'):
-        game_snapshot = make_snapshot_for_file(file)
+        game_snapshot = make_snapshot_for_file(file, full=full)
         game_snapshots.append(game_snapshot)
     snapshot = pl.concat(game_snapshots)
     if write:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
         snapshot.write_parquet(SNAPSHOT_DIR / f'{name}.parquet')
     return snapshot
 
@@ -40,7 +151,16 @@ def compare_file_snapshots(prev_idx=-2, cur_idx=-1):
     compare_snapshots(prev, cur)
 
 
+def snapshot_dates(snapshot):
+    """older snapshots have the first and last dates as strings"""
+    for col in ['first_date', 'last_date']:
+        if snapshot.schema[col] == pl.Utf8:
+            snapshot = snapshot.with_columns(pl.col(col).str.slice(0, 10).str.to_date('%Y-%m-%d'))
+    return snapshot
+
+
 def compare_snapshots(prev, cur):
+    prev, cur = snapshot_dates(prev), snapshot_dates(cur)
     prev = prev.with_columns(
         pl.when(pl.col("game_name") == "fifa").then(pl.lit("ea_sports_fc")).otherwise(pl.col("game_name")).alias("game_name")
     )
@@ -50,10 +170,10 @@ def compare_snapshots(prev, cur):
         (pl.col('num_matches_2').cast(pl.Int64) - pl.col('num_matches').cast(pl.Int64)).alias('diff_num_matches'),
         (pl.col('num_competitors_2').cast(pl.Int64) - pl.col('num_competitors').cast(pl.Int64)).alias('diff_num_competitors'),
         pl.when(pl.col('first_date') != pl.col('first_date_2')).then(
-           pl.format("{} -> {}", pl.col('first_date').str.slice(0,10), pl.col('first_date_2').str.slice(0,10)) 
+           pl.format("{} -> {}", pl.col('first_date'), pl.col('first_date_2'))
         ).otherwise(pl.lit('unchanged')).alias('first_date'),
         pl.when(pl.col('last_date') != pl.col('last_date_2')).then(
-             pl.format("{} -> {}", pl.col('last_date').str.slice(0,10), pl.col('last_date_2').str.slice(0,10))
+             pl.format("{} -> {}", pl.col('last_date'), pl.col('last_date_2'))
         ).otherwise(pl.lit('unchanged')).alias('last_date'),
         (pl.col('mean_outcome_2') - pl.col('mean_outcome')).alias('diff_mean_outcome'),
     ])
@@ -71,10 +191,13 @@ def compare_snapshots(prev, cur):
     summary = summary.vstack(total)
     print(summary)
 
-def make_and_compare():
+def make_and_compare(write=False, full=False):
     snapshots = sorted(glob.glob(f'{SNAPSHOT_DIR}/*.parquet'))
-    cur = make_snapshot().sort('num_matches', descending=True)
+    cur = make_snapshot(write=write, full=full).sort('num_matches', descending=True)
     print(cur)
+    if len(snapshots) == 0:
+        print('no previous snapshot to compare to')
+        return
     prev =  pl.read_parquet(snapshots[-1])
     compare_snapshots(prev, cur)
 
@@ -84,12 +207,13 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--make', action='store_true')
     parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--full', action='store_true', help='read all of the data instead of the parquet metadata')
     args = parser.parse_args()
     pl.Config.set_tbl_rows(200)  # Adjust the number of rows to display
     pl.Config.set_fmt_str_lengths(100)
     if args.make:
-        make_snapshot(write=True)
+        make_snapshot(write=True, full=args.full)
     elif args.compare:
         compare_file_snapshots()
     else:
-        make_and_compare()
+        make_and_compare(full=args.full)
@@ -1,7 +1,6 @@
-import json
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr, outcome_from_scores
+from esportsbench.utils import is_null_or_empty, outcome_from_scores
 
 
 class Starcraft1DataPipeline(LPDBDataPipeline):
@@ -9,7 +8,7 @@ class Starcraft1DataPipeline(LPDBDataPipeline):
 
     game = 'starcraft1'
     version = 'v3'
-    schema_overrides = {'match2games': json.dumps}
+    schema_overrides = {'match2games': LPDBDataPipeline.normalize_match2games}
     request_params_groups = {
         'starcraft1_1v1.jsonl': {
             'wiki': 'starcraft',
@@ -29,11 +28,10 @@ class Starcraft1DataPipeline(LPDBDataPipeline):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
 
     def process_data(self):
-        df = pl.read_ndjson(self.raw_data_dir / 'starcraft1_1v1.jsonl', infer_schema_length=97000 ,ignore_errors=False)
+        df = self.scan_raw('starcraft1_1v1.jsonl', ignore_errors=False)
 
-        print(f'initial 1v1 row count: {df.shape[0]}')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         two_v_two_expr = pl.col('pagename').str.to_lowercase().str.contains('2v2')
         df = self.filter_invalid(df, two_v_two_expr, '2v2')
@@ -124,15 +122,12 @@ class Starcraft1DataPipeline(LPDBDataPipeline):
         null_outcome_expr = pl.col('outcome').is_null()
         df = self.filter_invalid(df, null_outcome_expr, 'null_outcome')
 
-        team_matches = pl.scan_ndjson(self.raw_data_dir / 'starcraft1_team.jsonl', infer_schema_length=100).collect()
-        team_matches = self.filter_invalid(team_matches, invalid_date_expr, 'invalid_date_team')
-        print(f'initial team match row count: {team_matches.shape[0]}')
+        team_matches = self.scan_raw('starcraft1_team.jsonl')
+        team_matches = self.filter_invalid_dates(team_matches, 'invalid_date_team')
 
         team_games = self.unpack_team_matches(team_matches)
-        print(f'1v1 matches from team matches: {len(team_games)}')
 
         df = pl.concat([df, team_games], how='diagonal')
-        print(f'matches after merging: {len(df)}')
 
         played_self_expr = pl.col('player_1') == pl.col('player_2')
         df = self.filter_invalid(df, played_self_expr, 'played_self')
@@ -54,8 +54,9 @@ class Starcraft2DataPipeline(DataPipeline):
         return objects, is_done
 
     def process_data(self):
-        df = pl.scan_ndjson(self.raw_data_dir / 'starcraft2.jsonl', infer_schema_length=1).collect()
-        print(f'initial row count: {df.shape[0]}')
+        df = self.scan_raw('starcraft2.jsonl')
+
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         df = df.with_columns(
             pl.concat_str(
@@ -1,6 +1,6 @@
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr
+from esportsbench.utils import is_null_or_empty
 
 
 class TetrisDataPipeline(LPDBDataPipeline):
@@ -22,10 +22,9 @@ class TetrisDataPipeline(LPDBDataPipeline):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
 
     def process_data(self):
-        df = pl.scan_ndjson(self.raw_data_dir / 'tetris.jsonl', infer_schema_length=10000).collect()
-        print(f'initial row count: {df.shape[0]}')
+        df = self.scan_raw('tetris.jsonl')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         # filter out matches without exactly 2 players
         not_two_players_expr = pl.col('match2opponents').list.len() != 2
@@ -1,7 +1,7 @@
 import json
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr
+from esportsbench.utils import is_null_or_empty
 
 
 class ValorantDataPipeline(LPDBDataPipeline):
@@ -26,12 +26,11 @@ class ValorantDataPipeline(LPDBDataPipeline):
         super().__init__(rows_per_request=rows_per_request, timeout=timeout, **kwargs)
 
     def process_data(self):
-        df = pl.scan_ndjson(
-            self.raw_data_dir / 'valorant.jsonl', infer_schema_length=100000, ignore_errors=True
-        ).collect()
-        print(f'initial row count: {df.shape[0]}')
+        df = self.scan_raw(
+            'valorant.jsonl', ignore_errors=True
+        )
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         # filter out matches without exactly 2 teams
         not_two_teams_expr = pl.col('match2opponents').list.len() != 2
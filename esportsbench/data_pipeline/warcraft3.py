@@ -1,7 +1,6 @@
-import json
 import polars as pl
 from esportsbench.data_pipeline.data_pipeline import LPDBDataPipeline
-from esportsbench.utils import is_null_or_empty, invalid_date_expr
+from esportsbench.utils import is_null_or_empty
 
 
 class Warcraft3DataPipeline(LPDBDataPipeline):
@@ -9,7 +8,7 @@ class Warcraft3DataPipeline(LPDBDataPipeline):
 
     game = 'warcraft3'
     version = 'v3'
-    schema_overrides = {'match2games': json.dumps}
+    schema_overrides = {'match2games': LPDBDataPipeline.normalize_match2games}
     request_params_groups = {
         'warcraft3_1v1.jsonl': {
             'wiki': 'warcraft',
@@ -30,11 +29,10 @@ class Warcraft3DataPipeline(LPDBDataPipeline):
 
     def process_data(self):
         # df = pl.scan_ndjson(self.raw_data_dir / 'warcraft3.jsonl', infer_schema_length=100000).collect()
-        df = pl.read_ndjson(self.raw_data_dir / 'warcraft3_1v1.jsonl', ignore_errors=True)
+        df = self.scan_raw('warcraft3_1v1.jsonl', ignore_errors=True)
 
-        print(f'initial row count: {df.shape[0]}')
 
-        df = self.filter_invalid(df, invalid_date_expr, 'invalid_date')
+        df = self.filter_invalid_dates(df, 'invalid_date')
 
         # filter out matches without exactly 2 competitors
         not_two_players_expr = pl.col('match2opponents').list.len() != 2
@@ -122,15 +120,12 @@ class Warcraft3DataPipeline(LPDBDataPipeline):
         null_outcome_expr = pl.col('outcome').is_null()
         df = self.filter_invalid(df, null_outcome_expr, 'null_outcome')
 
-        team_matches = pl.scan_ndjson(self.raw_data_dir / 'warcraft3_team.jsonl', infer_schema_length=50000).collect()
-        team_matches = self.filter_invalid(team_matches, invalid_date_expr, 'invalid_date_team')
-        print(f'initial team match row count: {team_matches.shape[0]}')
+        team_matches = self.scan_raw('warcraft3_team.jsonl')
+        team_matches = self.filter_invalid_dates(team_matches, 'invalid_date_team')
 
         team_games = self.unpack_team_matches(team_matches)
-        print(f'1v1 matches from team matches: {len(team_games)}')
 
         df = pl.concat([df, team_games], how='diagonal')
-        print(f'matches after merging: {len(df)}')
 
         played_self_expr = pl.col('player_1') == pl.col('player_2')
         df = self.filter_invalid(df, played_self_expr, 'played_self')
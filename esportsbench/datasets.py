@@ -1,34 +1,90 @@
 """module for managing esports datasets for rating system experiments"""
+import os
+import json
+import shutil
+import hashlib
 import pathlib
+from datetime import date, timedelta
 import numpy as np
 import polars as pl
 from riix.utils.data_utils import TimedPairDataset
 from esportsbench.constants import GAME_NAME_MAP
 
-BASE_DATA_DIR = pathlib.Path(__file__).resolve().parents[1] / 'data' 
+BASE_DATA_DIR = pathlib.Path(__file__).resolve().parents[1] / 'data'
+CACHE_DIR = BASE_DATA_DIR / 'dataset_cache'
+# part of every dataset cache key, bump it whenever build_dataset's output changes so older entries aren't read
+# 2: the date filter is pushed into the scan and applied before max_rows
+DATASET_CACHE_VERSION = 2
 
 
-def load_dataset(
-    game,
-    rating_period='7D',
-    drop_draws=False,
-    max_rows=None,
-    train_end_date='2023-03-31',
-    test_end_date='2024-03-31',
-    data_dir = 'final_data',
-):
-    # map short name to full name if short name is provided
-    if game in GAME_NAME_MAP:
-        game = GAME_NAME_MAP[game]
-    df = pl.read_parquet(BASE_DATA_DIR / data_dir / f'parquet/{game}.parquet')
+def file_hash(path):
+    """content hash of a data file, memoized on its size and mtime so the file is only re-read when it changes"""
+    stat = path.stat()
+    memo_path = CACHE_DIR / 'file_hashes' / (hashlib.sha1(str(path.resolve()).encode()).hexdigest() + '.json')
+    if memo_path.exists():
+        memo = json.loads(memo_path.read_text())
+        if (memo['size'] == stat.st_size) and (memo['mtime_ns'] == stat.st_mtime_ns):
+            return memo['hash']
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while block := f.read(1 << 24):
+            hasher.update(block)
+    os.makedirs(memo_path.parent, exist_ok=True)
+    memo_path.write_text(json.dumps({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': hasher.hexdigest()}))
+    return hasher.hexdigest()
+
+
+def write_cached_dataset(cache_path, dataset, train_rows, test_rows):
+    """write next to the final location and rename so a partially written cache entry is never read"""
+    tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(tmp_path / 'time_steps.npy', np.ascontiguousarray(dataset.time_steps))
+    np.save(tmp_path / 'matchups.npy', np.ascontiguousarray(dataset.matchups))
+    np.save(tmp_path / 'outcomes.npy', np.ascontiguousarray(dataset.outcomes))
+    (tmp_path / 'competitors.json').write_text(json.dumps(list(dataset.competitors)))
+    (tmp_path / 'split.json').write_text(json.dumps({'train_rows': train_rows, 'test_rows': test_rows}))
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process cached the same dataset first
+        shutil.rmtree(tmp_path)
+
+
+def read_cached_dataset(cache_path):
+    """the arrays are memory mapped read only so processes loading the same dataset share its pages"""
+    # plain ndarray views of the maps, slicing np.memmap objects is slow in the per rating period loop
+    load = lambda name: np.asarray(np.load(cache_path / f'{name}.npy', mmap_mode='r'))
+    competitors = json.loads((cache_path / 'competitors.json').read_text())
+    dataset = TimedPairDataset.init_from_arrays(
+        time_steps=load('time_steps'),
+        matchups=load('matchups'),
+        outcomes=load('outcomes'),
+        competitors=competitors,
+    )
+    dataset.competitor_to_idx = dict(zip(competitors, range(len(competitors))))
+    split = json.loads((cache_path / 'split.json').read_text())
+    return dataset, split['train_rows'], split['test_rows']
+
+
+def build_dataset(data_path, rating_period, drop_draws, max_rows, train_end_date, test_end_date):
+    train_end_date = date.fromisoformat(train_end_date)
+    test_end_date = date.fromisoformat(test_end_date)
+    # only the columns the dataset needs are read and the date and draw filters are pushed into the parquet scan
+    df = pl.scan_parquet(data_path).select('date', 'competitor_1', 'competitor_2', 'outcome')
+    date_dtype = df.collect_schema()['date']
+    if date_dtype == pl.Utf8:
+        # final data written before dates were stored as dates
+        df = df.with_columns(pl.col('date').str.to_date('%Y-%m-%d'))
+        date_dtype = pl.Date
+    # full data has datetimes, the end dates are inclusive of the whole day
+    df = df.filter(pl.col('date') < pl.lit(test_end_date + timedelta(days=1)).cast(date_dtype))
     if drop_draws:
         df = df.filter(pl.col('outcome') != 0.5)
     if max_rows:
         df = df.head(max_rows)
-    train_mask = df['date'].cast(pl.Utf8) <= train_end_date
-    test_mask = (df['date'].cast(pl.Utf8) > train_end_date) & (df['date'].cast(pl.Utf8) <= test_end_date)
-    train_rows = int(train_mask.sum())
-    test_rows = int(test_mask.sum())
+    df = df.collect()
+    train_rows = int((df['date'].cast(pl.Date) <= train_end_date).sum())
+    test_rows = len(df) - train_rows
     dataset = TimedPairDataset(
         df=df,
         competitor_cols=['competitor_1', 'competitor_2'],
@@ -37,7 +93,73 @@ def load_dataset(
         rating_period=rating_period,
         verbose=True
     )
-    dataset = dataset[:train_rows + test_rows]
     print(f'dataset is split into {train_rows} train rows and {test_rows} test rows')
+    return dataset, train_rows, test_rows
+
+
+def cache_dataset(
+    game,
+    rating_period='7D',
+    drop_draws=False,
+    max_rows=None,
+    train_end_date='2023-03-31',
+    test_end_date='2024-03-31',
+    data_dir = 'final_data',
+):
+    """build the dataset into the cache if it isn't there already and return its cache path
+    the path is all another process needs to memory map the same arrays
+    """
+    # map short name to full name if short name is provided
+    if game in GAME_NAME_MAP:
+        game = GAME_NAME_MAP[game]
+    data_path = BASE_DATA_DIR / data_dir / f'parquet/{game}.parquet'
+    key = json.dumps([
+        DATASET_CACHE_VERSION, file_hash(data_path), rating_period, drop_draws, max_rows, train_end_date, test_end_date
+    ])
+    cache_path = CACHE_DIR / f'{game}_{hashlib.sha1(key.encode()).hexdigest()[:16]}'
+    if not cache_path.exists():
+        dataset, train_rows, test_rows = build_dataset(
+            data_path, rating_period, drop_draws, max_rows, train_end_date, test_end_date
+        )
+        write_cached_dataset(cache_path, dataset, train_rows, test_rows)
+    return cache_path
+
+
+def cached_dataset_rows(cache_path):
+    """number of matchups in a cached dataset without loading it"""
+    split = json.loads((cache_path / 'split.json').read_text())
+    return split['train_rows'] + split['test_rows']
+
+
+def load_cached_dataset(cache_path):
+    """returns the dataset and test mask from a path returned by cache_dataset"""
+    dataset, train_rows, test_rows = read_cached_dataset(cache_path)
+    return dataset, np.arange(train_rows + test_rows) >= train_rows
+
+
+def load_dataset(
+    game,
+    rating_period='7D',
+    drop_draws=False,
+    max_rows=None,
+    train_end_date='2023-03-31',
+    test_end_date='2024-03-31',
+    data_dir = 'final_data',
+    use_cache=True,
+):
+    if use_cache:
+        cache_path = cache_dataset(game, rating_period, drop_draws, max_rows, train_end_date, test_end_date, data_dir)
+        dataset, test_mask = load_cached_dataset(cache_path)
+        print(f'loaded cached dataset with {len(dataset)} matchups and {len(dataset.competitors)} competitors')
+        print(f'dataset is split into {(~test_mask).sum()} train rows and {test_mask.sum()} test rows')
+        return dataset, test_mask
+
+    # map short name to full name if short name is provided
+    if game in GAME_NAME_MAP:
+        game = GAME_NAME_MAP[game]
+    data_path = BASE_DATA_DIR / data_dir / f'parquet/{game}.parquet'
+    dataset, train_rows, test_rows = build_dataset(
+        data_path, rating_period, drop_draws, max_rows, train_end_date, test_end_date
+    )
     final_test_mask = np.arange(train_rows + test_rows) >= train_rows
     return dataset, final_test_mask
@@ -1,13 +1,167 @@
 """module for runninng benchmarks"""
-import os
+import hashlib
+import importlib.metadata
 import json
-from functools import partial
 import multiprocessing
+import os
+import pathlib
+import time
 from collections import defaultdict
+from functools import cache, partial
+
+import numpy as np
 from riix.eval import evaluate
-from esportsbench.arg_parsers import get_games_argparser, comma_separated
-from esportsbench.datasets import load_dataset
-from esportsbench.constants import GAME_NAME_MAP, ALL_RATING_SYSTEM_NAMES, RATING_SYSTEM_NAME_CLASS_MAP
+from riix.metrics import binary_metrics_suite
+
+from esportsbench.arg_parsers import comma_separated, get_games_argparser
+from esportsbench.constants import ALL_RATING_SYSTEM_NAMES, GAME_NAME_MAP, RATING_SYSTEM_NAME_CLASS_MAP
+from esportsbench.datasets import BASE_DATA_DIR, cache_dataset, cached_dataset_rows, load_cached_dataset
+
+# seconds per matchup for each rating system, learned from the durations of previous runs
+COSTS_PATH = BASE_DATA_DIR / 'benchmark_costs.json'
+
+
+def read_costs():
+    if COSTS_PATH.exists():
+        return json.loads(COSTS_PATH.read_text())
+    return {}
+
+
+def update_costs(costs, durations):
+    """durations is a list of (rating system name, rows, duration in seconds) from this run"""
+    totals = defaultdict(lambda: [0.0, 0])
+    for rating_system_name, rows, duration in durations:
+        totals[rating_system_name][0] += duration
+        totals[rating_system_name][1] += rows
+    for rating_system_name, (duration, rows) in totals.items():
+        if rows > 0:
+            costs[rating_system_name] = duration / rows
+    os.makedirs(COSTS_PATH.parent, exist_ok=True)
+    COSTS_PATH.write_text(json.dumps(costs, indent=2))
+
+
+# metrics of previous evaluate calls, keyed by a fingerprint of everything which determines them
+RESULT_CACHE_DIR = BASE_DATA_DIR / 'result_cache'
+
+
+def rating_system_id(rating_system_class):
+    """the baselines are partials of one class with different arguments"""
+    if isinstance(rating_system_class, partial):
+        return [rating_system_id(rating_system_class.func), rating_system_class.args, rating_system_class.keywords]
+    return f'{rating_system_class.__module__}.{rating_system_class.__qualname__}'
+
+
+def result_key(cache_path, rating_system_key, rating_system_class, params):
+    """the dataset cache path name already hashes the cache version, data file content, split dates,
+    rating period, drop draws and max rows
+    """
+    key = json.dumps(
+        [
+            cache_path.name,
+            rating_system_key,
+            rating_system_id(rating_system_class),
+            params,
+            importlib.metadata.version('riix'),
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def read_result(key):
+    path = RESULT_CACHE_DIR / f'{key}.json'
+    if not path.exists():
+        return None
+    # bump the mtime so eviction drops the least recently used results first
+    os.utime(path)
+    return json.loads(path.read_text())
+
+
+def json_metrics(metrics):
+    return {name: float(value) for name, value in metrics.items()}
+
+
+def write_result(key, metrics):
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    tmp_path = RESULT_CACHE_DIR / f'{key}.{os.getpid()}.tmp'
+    tmp_path.write_text(json.dumps(json_metrics(metrics)))
+    os.replace(tmp_path, RESULT_CACHE_DIR / f'{key}.json')
+
+
+def evict_results(max_age_days=90, max_bytes=64 * 1024 * 1024):
+    """delete cached results not used in max_age_days, then the least recently used until the cache fits in max_bytes"""
+    if not RESULT_CACHE_DIR.exists():
+        return
+    now = time.time()
+    entries = []
+    for path in RESULT_CACHE_DIR.glob('*.json'):
+        stat = path.stat()
+        if now - stat.st_mtime > max_age_days * 24 * 60 * 60:
+            path.unlink()
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        path.unlink()
+        total_bytes -= size
+
+
+# per match pre match probabilities, one float32 array per result key aligned with the rows of the cached dataset
+PREDICTIONS_DIR = BASE_DATA_DIR / 'predictions'
+
+
+def predictions_path(cache_path, key):
+    return PREDICTIONS_DIR / cache_path.name / f'{key}.npy'
+
+
+def evaluate_and_save(rating_system, dataset, test_mask, save_path):
+    """same as riix evaluate but the probabilities for every match are saved before the metrics are computed"""
+    start_time = time.time()
+    probs = rating_system.fit_dataset(dataset, return_pre_match_probs=True)
+    duration = time.time() - start_time
+    os.makedirs(save_path.parent, exist_ok=True)
+    tmp_path = save_path.with_name(f'{save_path.stem}.{os.getpid()}.tmp.npy')
+    np.save(tmp_path, probs.astype(np.float32))
+    os.replace(tmp_path, save_path)
+    metrics = binary_metrics_suite(probs[test_mask], dataset.outcomes[test_mask])
+    metrics['duration'] = duration
+    return metrics
+
+
+def load_predictions(record):
+    """probabilities, outcomes and test mask for a journal record of a run with save_predictions
+    eg new metrics can be computed as metric(probs[test_mask], outcomes[test_mask]) without refitting
+    """
+    dataset, test_mask = load_cached_dataset(pathlib.Path(record['dataset']))
+    probs = np.load(record['predictions'], mmap_mode='r')
+    return probs, dataset.outcomes, test_mask
+
+
+def read_journal(journal_path):
+    """metrics of the records in a benchmark journal keyed by result key"""
+    journaled = {}
+    if not os.path.exists(journal_path):
+        return journaled
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line can be cut off if the run was killed mid write
+                continue
+            journaled[record['key']] = record['metrics']
+    return journaled
+
+
+def append_journal(journal_path, record):
+    """one json line per finished task, flushed to disk right away so it survives the run crashing"""
+    with open(journal_path, 'a') as journal:
+        journal.write(json.dumps(record, default=str) + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
 
 
 def add_mean_metrics(data_dict):
@@ -37,10 +191,20 @@ def add_mean_metrics(data_dict):
     return data_dict
 
 
+@cache
+def worker_dataset(cache_path):
+    """each worker memory maps a game's arrays once and reuses them for every rating system"""
+    return load_cached_dataset(cache_path)
+
+
 def eval_func(input_tuple):
-    game_name, rating_system_name, dataset, rating_system_class, params, test_mask = input_tuple
+    game_name, rating_system_name, cache_path, rating_system_class, params, save_path = input_tuple
+    dataset, test_mask = worker_dataset(cache_path)
     rating_system = rating_system_class(competitors=dataset.competitors, **params)
-    metrics = evaluate(rating_system, dataset, metrics_mask=test_mask)
+    if save_path is None:
+        metrics = evaluate(rating_system, dataset, metrics_mask=test_mask)
+    else:
+        metrics = evaluate_and_save(rating_system, dataset, test_mask, save_path)
     # rating_system.print_leaderboard(5)
     return (game_name, rating_system_name, metrics)
 
@@ -55,6 +219,11 @@ def run_benchmark(
     rating_systems=ALL_RATING_SYSTEM_NAMES,
     hyperparameter_config='default',
     num_processes=8,
+    use_result_cache=True,
+    journal_path=None,
+    resume=False,
+    save_predictions=False,
+    overwrite_journal=False,
 ):
     """run a benchmark where all rating systems use default values"""
     results = defaultdict(dict)
@@ -63,7 +232,8 @@ def run_benchmark(
         for game_short_name in games:
             game_name = GAME_NAME_MAP[game_short_name]
             print(game_name)
-            dataset, test_mask = load_dataset(
+            # workers are only sent the cache path, the arrays are memory mapped from disk instead of pickled per task
+            cache_path = cache_dataset(
                 game=game_name,
                 rating_period=rating_period,
                 drop_draws=drop_draws,
@@ -102,14 +272,103 @@ def run_benchmark(
                     raise ValueError('Expected config to be either a path or a dict')
                 if 'model' in params: del params['model']
                 rating_system_class = RATING_SYSTEM_NAME_CLASS_MAP[rating_system_name]
-                yield (game_name, rating_system_key, dataset, rating_system_class, params, test_mask)
+                yield (game_name, rating_system_key, cache_path, rating_system_class, params)
             
-    pool = multiprocessing.Pool(processes=num_processes)
-    # eval_results = map(eval_func, eval_iterator()) # for debugging, better error messages without multiprocessing
-    eval_results = pool.imap(eval_func, eval_iterator())
+    tasks = list(eval_iterator())
+    keys = {
+        (game_name, rating_system_key): result_key(cache_path, rating_system_key, rating_system_class, params)
+        for game_name, rating_system_key, cache_path, rating_system_class, params in tasks
+    }
+    task_params = {(task[0], task[1]): task[4] for task in tasks}
+    task_datasets = {(task[0], task[1]): task[2] for task in tasks}
+    save_paths = {
+        task_id: predictions_path(task_datasets[task_id], key) if save_predictions else None
+        for task_id, key in keys.items()
+    }
+    # a previous result can only be reused if its predictions were saved too when they are wanted
+    has_predictions = lambda task_id: (save_paths[task_id] is None) or save_paths[task_id].exists()
+    finished = {}
+    if journal_path is not None:
+        journaled = read_journal(journal_path)
+        if resume:
+            for task_id, key in keys.items():
+                if (key in journaled) and has_predictions(task_id):
+                    finished[task_id] = journaled[key]
+            print(f'{len(finished)} of {len(tasks)} results are already in {journal_path}')
+            if os.path.exists(journal_path) and (os.path.getsize(journal_path) > 0):
+                # end a cut off last line so the next record isn't appended onto it
+                with open(journal_path, 'rb+') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')
+        else:
+            # a journal missing some of these results may be the only record of an unfinished run, don't lose it
+            if journaled and (not overwrite_journal) and any(key not in journaled for key in keys.values()):
+                raise FileExistsError(
+                    f'{journal_path} has results of a run which may not have finished, '
+                    'resume it with --resume or start over with --overwrite_journal'
+                )
+            pathlib.Path(journal_path).write_text('')
 
-    for game_name, rating_system_name, metrics in eval_results:
-        results[game_name][rating_system_name] = metrics
+    def finish(game_name, rating_system_key, metrics, cached):
+        finished[(game_name, rating_system_key)] = metrics
+        if journal_path is not None:
+            append_journal(
+                journal_path,
+                {
+                    'key': keys[(game_name, rating_system_key)],
+                    'game': game_name,
+                    'rating_system': rating_system_key,
+                    'params': task_params[(game_name, rating_system_key)],
+                    'metrics': json_metrics(metrics),
+                    'cached': cached,
+                    'finished_at': time.time(),
+                    'dataset': str(task_datasets[(game_name, rating_system_key)]),
+                    'predictions': str(save_paths[(game_name, rating_system_key)]) if save_predictions else None,
+                },
+            )
+
+    if use_result_cache:
+        num_cached = 0
+        for (game_name, rating_system_key), key in keys.items():
+            if ((game_name, rating_system_key) in finished) or not has_predictions((game_name, rating_system_key)):
+                continue
+            metrics = read_result(key)
+            if metrics is not None:
+                finish(game_name, rating_system_key, metrics, cached=True)
+                num_cached += 1
+        print(f'{num_cached} of {len(tasks)} results are cached')
+    to_run = [task + (save_paths[(task[0], task[1])],) for task in tasks if (task[0], task[1]) not in finished]
+
+    # the most expensive tasks are started first so a slow system on a big game doesn't start last and set the wall time
+    costs = read_costs()
+    default_cost = sum(costs.values()) / len(costs) if costs else 1.0
+    rows = {task[2]: cached_dataset_rows(task[2]) for task in tasks}
+    task_cost = lambda task: rows[task[2]] * costs.get(task[1], default_cost)
+    if to_run:
+        pool = multiprocessing.Pool(processes=num_processes)
+        # for debugging, better error messages without multiprocessing
+        # eval_results = map(eval_func, sorted(to_run, key=task_cost, reverse=True))
+        eval_results = pool.imap_unordered(eval_func, sorted(to_run, key=task_cost, reverse=True))
+        for game_name, rating_system_name, metrics in eval_results:
+            finish(game_name, rating_system_name, metrics, cached=False)
+            if use_result_cache:
+                write_result(keys[(game_name, rating_system_name)], metrics)
+        pool.close()
+    if use_result_cache:
+        evict_results()
+
+    # results are put back in game then rating system order regardless of which finished first
+    for game_name, rating_system_key, _, _, _ in tasks:
+        results[game_name][rating_system_key] = finished[(game_name, rating_system_key)]
+    # only tasks fit in this run say anything about current costs,
+    # the durations of cached and journaled results were already learned from
+    if to_run:
+        durations = [
+            (rating_system_key, rows[cache_path], finished[(game_name, rating_system_key)]['duration'])
+            for game_name, rating_system_key, cache_path, _, _, _ in to_run
+        ]
+        update_costs(costs, durations)
 
     results = add_mean_metrics(results)
     return results
@@ -158,6 +417,26 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--data_dir', type=str, default='final_data_v10')
     parser.add_argument('-c', '--hyperparameter_config', type=str, required=False, default='default')
     parser.add_argument('-np', '--num_processes', type=int, default=8)
+    parser.add_argument(
+        '-nc', '--no_result_cache', action='store_true', help='refit every rating system even if its result is cached'
+    )
+    parser.add_argument(
+        '-j',
+        '--journal',
+        type=str,
+        default=str(BASE_DATA_DIR / 'benchmark_journal.jsonl'),
+        help='jsonl file each finished result is appended to',
+    )
+    parser.add_argument('--resume', action='store_true', help='skip tasks which are already in the journal')
+    parser.add_argument(
+        '--overwrite_journal', action='store_true', help='start a new journal even if the old one is missing results'
+    )
+    parser.add_argument(
+        '-sp',
+        '--save_predictions',
+        action='store_true',
+        help='save every match probability as float32 under data/predictions',
+    )
     args = parser.parse_args()
 
     results = run_benchmark(
@@ -169,5 +448,10 @@ if __name__ == '__main__':
         drop_draws=args.drop_draws,
         hyperparameter_config=args.hyperparameter_config,
         num_processes=args.num_processes,
+        use_result_cache=not args.no_result_cache,
+        journal_path=args.journal,
+        resume=args.resume,
+        save_predictions=args.save_predictions,
+        overwrite_journal=args.overwrite_journal,
     )
     print_results(results)
@@ -1,5 +1,3 @@
-import os
-import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 from esportsbench.arg_parsers import get_games_argparser, comma_separated
@@ -70,29 +68,23 @@ def main(
 ):
     rating_periods = [1, 7, 14, 28]
     sweep_results_base = 'conf/sweep_results/fine_sweep'
-    metrics_file = 'metrics.pkl'
-    if os.path.exists(metrics_file):
-        print(f"using cached metrics from {metrics_file}")
-        metrics = pickle.load(open(metrics_file, 'rb'))
-    else:
-        print("computing metrics")
-        metrics = []
-        for rating_period in rating_periods:
-            config_path = f"{sweep_results_base}_{rating_period}D_1000"
-            print(f'getting test set results for {config_path}')
-            results = run_benchmark(
-                games=games,
-                rating_systems=rating_systems,
-                rating_period=f"{rating_period}D",
-                train_end_date=train_end_date,
-                test_end_date=test_end_date,
-                data_dir=data_dir,
-                drop_draws=drop_draws,
-                hyperparameter_config=config_path
-            )
-            metrics.append(results)
-            print(results)
-        pickle.dump(metrics, open(metrics_file, 'wb'))
+    # run_benchmark's result cache returns the metrics of unchanged games and configs without refitting
+    metrics = []
+    for rating_period in rating_periods:
+        config_path = f"{sweep_results_base}_{rating_period}D_1000"
+        print(f'getting test set results for {config_path}')
+        results = run_benchmark(
+            games=games,
+            rating_systems=rating_systems,
+            rating_period=f"{rating_period}D",
+            train_end_date=train_end_date,
+            test_end_date=test_end_date,
+            data_dir=data_dir,
+            drop_draws=drop_draws,
+            hyperparameter_config=config_path
+        )
+        metrics.append(results)
+        print(results)
 
     plot_metrics_vs_duration(metrics, rating_periods)
 
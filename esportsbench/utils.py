@@ -1,4 +1,6 @@
 """utility functions for dealing with match data"""
+import os
+import multiprocessing
 from typing import Tuple, Optional
 import polars as pl
 
@@ -32,56 +34,50 @@ def is_null_or_empty(col):
     return col.is_null() | (col.cast(pl.Utf8) == '') | (col.cast(pl.Utf8) == 'False')
 
 
+def polars_pool(num_processes):
+    """process pool for running polars work in parallel, polars isn't fork safe so the workers are spawned
+    each worker gets an even share of the cores, polars would otherwise start a thread per core in every process
+    """
+    prev_max_threads = os.environ.get('POLARS_MAX_THREADS')
+    os.environ['POLARS_MAX_THREADS'] = str(max(1, os.cpu_count() // num_processes))
+    try:
+        # the workers read the environment when they start, which is when the pool is created
+        return multiprocessing.get_context('spawn').Pool(num_processes)
+    finally:
+        if prev_max_threads is None:
+            del os.environ['POLARS_MAX_THREADS']
+        else:
+            os.environ['POLARS_MAX_THREADS'] = prev_max_threads
+
+
 def delimited_list(string_list, delimiter=','):
     return string_list.split(delimiter)
 
 
-# lots of ways a date can be bad lol
-invalid_date_expr = (
-    pl.col('date').is_null()
-    | (pl.col('date') == '')
-    | (pl.col('date').str.to_datetime().dt.year() == 0)
-    | (pl.col('date').str.to_datetime().dt.year() == 1000)
-    | (pl.col('date').str.to_datetime().dt.year() == 1970)
+# dates come as 'YYYY-MM-DD HH:MM:SS' from LPDB and leaguepedia and as 'YYYY-MM-DD' from aligulac
+# they are parsed once here and kept as datetimes from then on
+parsed_date_expr = pl.coalesce(
+    pl.col('date').str.to_datetime('%Y-%m-%d %H:%M:%S', time_unit='ms', strict=False),
+    pl.col('date').str.to_datetime('%Y-%m-%d', time_unit='ms', strict=False),
 )
 
+
+def invalid_date(date):
+    """lots of ways a date can be bad lol, dates which didn't parse are null"""
+    if isinstance(date, str):
+        date = pl.col(date)
+    return date.is_null() | date.dt.year().is_in([0, 1000, 1970])
+
+
+invalid_date_expr = invalid_date(parsed_date_expr)
+
 def debug_ndjson(file_path: str) -> Tuple[Optional[int], Optional[str]]:
-    def attempt_read(n: int) -> bool:
-        try:
-            # pl.read_ndjson(file_path, n_rows=n)
-            pl.scan_ndjson(file_path, n_rows=n, infer_schema_length=n).collect()
-
-            return True
-        except Exception as e:
-            print(e)
-            return False
-
-    with open(file_path, 'r') as f:
-        total_lines = sum(1 for _ in f)
-
-    left, right = 1, total_lines
-    last_failing = None
-
-    while left <= right:
-        mid = (left + right) // 2
-        if attempt_read(mid):
-            left = mid + 1
-        else:
-            last_failing = mid
-            right = mid - 1
+    """first line which doesn't fit the file's schema, debug_schema.validate_ndjson reports all of them"""
+    from esportsbench.data_pipeline.debug_schema import validate_ndjson
 
-    if last_failing is None:
+    bad_lines = validate_ndjson(file_path)
+    if len(bad_lines) == 0:
         return None, "No errors found in the file."
-
-    # Find the exact failing line
-    for i in range(max(1, last_failing - 10), last_failing + 1):
-        if not attempt_read(i):
-            # Read the problematic line
-            with open(file_path, 'r') as f:
-                for _ in range(i - 1):
-                    next(f)
-                problematic_line = next(f).strip()
-            return i, f"Error on line {i}: {problematic_line}"
-
-    return None, "Could not pinpoint the exact error location."
-    
\ No newline at end of file
+    line_number, offset, conflicts = bad_lines[0]
+    conflict_str = ', '.join(f'{field}: expected {expected}, got {actual}' for field, expected, actual in conflicts)
+    return line_number, f"Error on line {line_number} (byte {offset}): {conflict_str}"